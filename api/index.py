@@ -1,28 +1,124 @@
-
 """
 Vercel Serverless Function - 智能 AI API 服务
 提供真正的智能响应，包括数学计算、智能问答等
 支持上下文记忆和多轮对话
 """
+import io
 import json
 import time
 import random
+import select
 import string
 import os
 import re
+import ast
+import sys
+import math
+import operator
+import functools
 import hashlib
+import hmac
+import atexit
+import base64
+import bisect
+import gzip
+import sqlite3
+import struct
+import queue
+import threading
+import unicodedata
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler
-from collections import deque, defaultdict
+from collections import deque, namedtuple, OrderedDict
 from datetime import datetime, timedelta
 
 # 配置
 API_KEY = os.environ.get('API_KEY', 'sk-default-key-please-change')
 
-# 会话存储（简单的内存缓存）
+# 多密钥：API_KEYS 为逗号分隔的 key[:rpm[:tpm]]，API_KEYS_FILE 每行一个 "key [rpm] [tpm]"（# 开头为注释）
+# RATE_LIMIT / TOKEN_RATE_LIMIT 为未单独指定限额的密钥的默认每分钟请求数 / token 数，0 表示不限
+API_KEYS = os.environ.get('API_KEYS', '')
+API_KEYS_FILE = os.environ.get('API_KEYS_FILE', '')
+RATE_LIMIT = int(os.environ.get('RATE_LIMIT', 0))
+TOKEN_RATE_LIMIT = int(os.environ.get('TOKEN_RATE_LIMIT', 0))
+
+# 准入控制：聊天接口的并发上限（0 表示不限制）、等待队列长度与排队时间上限（秒），
+# 以及自适应调整并发上限所参照的目标延迟（秒）
+MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', 64))
+MIN_CONCURRENCY = int(os.environ.get('MIN_CONCURRENCY', 4))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 128))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 2))
+ADMISSION_TARGET_LATENCY = float(os.environ.get('ADMISSION_TARGET_LATENCY', 1))
+
+# 批量接口（/v1/batch）：单次请求最多的行数与并发执行的工作线程数
+BATCH_MAX_LINES = int(os.environ.get('BATCH_MAX_LINES', 50000))
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 8))
+
+# 单次请求 n / best_of 的上限（与 OpenAI 一致）
+MAX_CHOICES = int(os.environ.get('MAX_CHOICES', 128))
+
+# 嵌入接口（/v1/embeddings）：计算方式 auto（已安装 numpy 时整批向量化计算）/ numpy / python，以及单次请求的最大输入条数
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'auto').lower()
+EMBEDDING_MAX_INPUTS = int(os.environ.get('EMBEDDING_MAX_INPUTS', 2048))
+
+# 会话存储（内存缓存，见 SessionStore）
 # 注意：这在 Vercel serverless 环境中会在每次冷启动时重置
-conversation_memory = defaultdict(lambda: deque(maxlen=10))  # 每个会话最多保存10轮对话
-session_last_access = {}  # 记录会话最后访问时间
+SESSION_HISTORY_SIZE = 10  # 每个会话最多保存10轮对话
 MAX_SESSION_AGE = 3600  # 会话最大存活时间（秒）
+MAX_SESSIONS = int(os.environ.get('MAX_SESSIONS', 10000))  # 会话总数上限，超出后淘汰最久未访问的会话
+
+# 会话持久化后端：memory（默认，仅进程内）或 sqlite（跨重启、跨工作进程共享）
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'memory').lower()
+SESSION_DB_PATH = os.environ.get(
+    'SESSION_DB_PATH',
+    '/tmp/cursor2api-sessions.db' if os.environ.get('VERCEL') else 'sessions.db'
+)
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', 2))  # 进程内缓存多久后重新从后端读取（秒）
+
+# 确定性回复的缓存（条目数为 0 时禁用）
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 4096))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 300))  # 秒
+
+# JSON 编解码：auto（优先 orjson，其次 ujson，最后标准库）/ orjson / ujson / json；JSON_PRETTY=1 时响应缩进输出便于调试
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto').lower()
+JSON_PRETTY = os.environ.get('JSON_PRETTY', '').lower() in ('1', 'true', 'yes')
+
+# 慢请求日志：处理总耗时超过阈值（秒）的请求按采样率把各阶段耗时以 JSON 行写入 stderr
+SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD', 1))
+SLOW_REQUEST_SAMPLE_RATE = float(os.environ.get('SLOW_REQUEST_SAMPLE_RATE', 1))
+
+# /metrics 访问密钥，未设置时无需认证
+METRICS_KEY = os.environ.get('METRICS_KEY', '')
+
+# 管理接口密钥（会话导出/导入），未设置时管理接口禁用
+ADMIN_KEY = os.environ.get('ADMIN_KEY', '')
+
+# 静态响应（/ 与 /v1/models）的缓存时间（秒）
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', 60))  # 浏览器/客户端缓存
+STATIC_S_MAXAGE = int(os.environ.get('STATIC_S_MAXAGE', 300))  # CDN 等共享缓存，仅用于公开的文档页
+
+# token 计数：approx（内置近似分词，默认）、tiktoken（已安装时对 OpenAI 模型精确计数，否则回退 approx）
+TOKEN_COUNTER = os.environ.get('TOKEN_COUNTER', 'approx').lower()
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 8192))  # 按内容摘要缓存的计数结果条数
+
+# 流式响应累计多少字节后写出一次（0 表示每个 chunk 单独写出）
+STREAM_FLUSH_BYTES = int(os.environ.get('STREAM_FLUSH_BYTES', 16384))
+# 流式响应默认的切分粒度（word / char / grapheme / bytes:N / window:毫秒）与输出速率（每秒片段数，0 表示不限速）
+# 请求可通过 stream_options.granularity / stream_options.tokens_per_second 覆盖
+STREAM_GRANULARITY = os.environ.get('STREAM_GRANULARITY', 'word')
+STREAM_TOKENS_PER_SECOND = float(os.environ.get('STREAM_TOKENS_PER_SECOND', 0))
+# 限速的下限（每秒片段数）与限速流的最长总时长（秒），避免极小速率把连接占用过久
+STREAM_MIN_TOKENS_PER_SECOND = float(os.environ.get('STREAM_MIN_TOKENS_PER_SECOND', 1))
+STREAM_MAX_DURATION = float(os.environ.get('STREAM_MAX_DURATION', 60))
+MAX_STREAM_WINDOW_MS = 10000  # window:MS 的上限
+MAX_STREAM_CHUNK_BYTES = 65536  # bytes:N 的上限
+
+# HTTP/1.1 持久连接
+KEEPALIVE_TIMEOUT = 15  # 空闲连接超时时间（秒）
+KEEPALIVE_BUSY_TIMEOUT = 1.0  # 线程池已满时空闲连接的超时时间（秒），到期即关闭以让出线程
+KEEPALIVE_POLL_INTERVAL = 0.1  # 等待下一个请求时检查线程池是否已满的间隔（秒）
+MAX_DRAIN_SIZE = 64 * 1024  # 未读取的请求体超过此大小时直接关闭连接而不是读完丢弃
 
 # 支持的模型
 MODELS = [
@@ -38,42 +134,986 @@ MODELS = [
     "code-supernova-1-million"
 ]
 
+MODEL_NAMES = frozenset(MODELS)
+
 def generate_random_string(length):
     """生成随机字符串"""
     return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
 
-def process_math(message):
-    """处理数学计算"""
-    # 清理输入 - 移除常见的问题词汇
-    cleaned = message.replace('?', '').replace('=', '').replace('？', '').strip()
+class JSONCodec:
+    """
+    JSON 编解码器，所有请求解析与响应序列化都经过这里
+    默认输出紧凑格式（无多余空格、非 ASCII 字符不转义），pretty=True 时缩进 2 格；
+    自动选用已安装的 orjson / ujson，遇到加速库不支持的值（如超过 64 位的整数）时回退标准库
+    """
+    
+    BACKENDS = ('orjson', 'ujson', 'json')
+    
+    def __init__(self, backend='auto', pretty=False):
+        self.pretty = pretty
+        candidates = self.BACKENDS if backend == 'auto' else (backend, 'json')
+        if backend not in self.BACKENDS and backend != 'auto':
+            print(f"未知的 JSON_BACKEND: {backend}，使用标准库 json", file=sys.stderr)
+            candidates = ('json',)
+        for name in candidates:
+            try:
+                self._setup(name)
+                break
+            except ImportError:
+                if backend != 'auto':
+                    print(f"JSON_BACKEND={backend} 但未安装 {backend}，使用标准库 json", file=sys.stderr)
+    
+    def _setup(self, name):
+        if name == 'orjson':
+            import orjson
+            self._encode = lambda obj, pretty, sort_keys: orjson.dumps(obj, option=(
+                (orjson.OPT_INDENT_2 if pretty else 0) | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+            ))
+            self._decode = orjson.loads
+        elif name == 'ujson':
+            import ujson
+            self._encode = lambda obj, pretty, sort_keys: ujson.dumps(
+                obj, ensure_ascii=False, escape_forward_slashes=False, indent=2 if pretty else 0,
+                sort_keys=sort_keys
+            ).encode('utf-8', 'surrogatepass')
+            self._decode = ujson.loads
+        else:
+            self._encode = self._stdlib_encode
+            self._decode = json.loads
+        self.backend = name
+    
+    @staticmethod
+    def _stdlib_encode(obj, pretty, sort_keys=False):
+        if pretty:
+            return json.dumps(obj, ensure_ascii=False, indent=2,
+                              sort_keys=sort_keys).encode('utf-8', 'surrogatepass')
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'),
+                          sort_keys=sort_keys).encode('utf-8', 'surrogatepass')
+    
+    def encode(self, obj, pretty=None, sort_keys=False):
+        """序列化为 UTF-8 bytes；pretty 为 None 时使用默认设置，sort_keys 为 True 时按键排序（用于计算摘要）"""
+        pretty = self.pretty if pretty is None else pretty
+        try:
+            return self._encode(obj, pretty, sort_keys)
+        except (TypeError, ValueError, OverflowError):
+            if self._encode == self._stdlib_encode:
+                raise
+            return self._stdlib_encode(obj, pretty, sort_keys)
+    
+    def dumps(self, obj, sort_keys=False):
+        """序列化为紧凑的 str（用于存储与计算摘要）"""
+        return self.encode(obj, pretty=False, sort_keys=sort_keys).decode('utf-8', 'surrogatepass')
+    
+    def decode(self, data):
+        """解析 bytes 或 str，格式错误时抛出 ValueError"""
+        return self._decode(data)
+
+json_codec = JSONCodec(JSON_BACKEND, JSON_PRETTY)
+
+class MetricsRegistry:
+    """
+    Prometheus 指标注册表
+    每个线程写入自己的分片（普通 dict，无需加锁），抓取时再把所有分片相加，
+    因此请求路径上的指标更新只是一次字典读写。
+    线程结束后其分片并入 _retired 合计，短命线程（如批量任务的工作线程）不会让分片无限增多
+    """
+    
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = {}  # id(分片) -> 分片，只含存活线程的分片
+        self._retired = {}  # 已结束线程的分片之和
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._callbacks = []
+    
+    def shard(self):
+        try:
+            return self._local.shard.values
+        except AttributeError:
+            holder = self._local.shard = MetricShard()
+            with self._lock:
+                self._shards[id(holder.values)] = holder.values
+            # 线程结束时 threading.local 释放 holder，触发合并；回调只引用分片本身，不引用 holder
+            weakref.finalize(holder, self._retire, holder.values)
+            return holder.values
+    
+    def _retire(self, shard):
+        with self._lock:
+            self._shards.pop(id(shard), None)
+            add_shard(self._retired, shard)
+    
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(self, name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+    
+    def histogram(self, name, help_text, labelnames=(), buckets=None):
+        metric = Histogram(self, name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+    
+    def callback(self, name, help_text, metric_type, labelnames, collect):
+        """抓取时调用 collect() 取值的指标，collect 返回 [(标签值元组, 数值), ...]"""
+        self._callbacks.append((name, help_text, metric_type, labelnames, collect))
+    
+    def _merged(self):
+        # 合计与分片列表在同一次加锁内取快照，期间结束的线程不会被重复或遗漏计数
+        with self._lock:
+            shards = list(self._shards.values())
+            merged = {}
+            add_shard(merged, self._retired)
+        for shard in shards:
+            add_shard(merged, shard.copy())
+        return merged
+    
+    def render(self):
+        """以 Prometheus 文本格式输出全部指标"""
+        merged = self._merged()
+        lines = []
+        for metric in self._metrics:
+            metric.render(lines, {labels: value for (m, labels), value in merged.items() if m is metric})
+        for name, help_text, metric_type, labelnames, collect in self._callbacks:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in collect():
+                lines.append(f'{name}{format_labels(labelnames, labels)} {format_metric_value(value)}')
+        return ('\n'.join(lines) + '\n').encode()
+
+class MetricShard:
+    """线程的指标分片持有者，随线程结束被回收（dict 本身不支持弱引用）"""
+    
+    __slots__ = ('values', '__weakref__')
+    
+    def __init__(self):
+        self.values = {}
+
+def add_shard(total, shard):
+    """把分片累加到 total：计数为数值，直方图为各桶计数列表"""
+    for key, value in shard.items():
+        if isinstance(value, list):
+            current = total.get(key)
+            if current is None:
+                total[key] = list(value)
+            else:
+                for i, v in enumerate(value):
+                    current[i] += v
+        else:
+            total[key] = total.get(key, 0) + value
+
+def format_labels(names, values, extra=''):
+    """格式化标签，按 Prometheus 规则转义"""
+    parts = [
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+def format_metric_value(value):
+    if isinstance(value, float) and value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    
+    def __init__(self, registry, name, help_text, labelnames):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+    
+    def inc(self, *labels, value=1):
+        shard = self.registry.shard()
+        key = (self, labels)
+        shard[key] = shard.get(key, 0) + value
+    
+    def render(self, lines, values):
+        lines.append(f'# HELP {self.name} {self.help_text}')
+        lines.append(f'# TYPE {self.name} counter')
+        for labels, value in sorted(values.items()):
+            lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {format_metric_value(value)}')
+
+class Histogram:
+    
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    
+    def __init__(self, registry, name, help_text, labelnames, buckets=None):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets or self.DEFAULT_BUCKETS)
+    
+    def observe(self, value, *labels):
+        shard = self.registry.shard()
+        key = (self, labels)
+        # 分片中保存各桶（含 +Inf）的非累计计数，最后一项为观测值之和
+        counts = shard.get(key)
+        if counts is None:
+            counts = shard[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+    
+    def render(self, lines, values):
+        lines.append(f'# HELP {self.name} {self.help_text}')
+        lines.append(f'# TYPE {self.name} histogram')
+        for labels, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="%s"' % format_metric_value(float(bound))
+                lines.append(f'{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {format_metric_value(float(counts[-1]))}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}')
+
+metrics = MetricsRegistry()
+metric_requests = metrics.counter('cursor2api_requests_total', 'HTTP requests by route, method and status', ('route', 'method', 'status'))
+metric_request_seconds = metrics.histogram('cursor2api_request_duration_seconds', 'Time from dispatch to response fully sent', ('route',))
+metric_model_requests = metrics.counter('cursor2api_model_requests_total', 'Chat completions by model', ('model',))
+metric_model_seconds = metrics.histogram('cursor2api_model_request_duration_seconds', 'Chat completion latency by model', ('model',))
+metric_stream_seconds = metrics.histogram('cursor2api_stream_duration_seconds', 'Duration of SSE streams')
+metric_stream_chunks = metrics.histogram('cursor2api_stream_chunks', 'SSE chunks per stream', buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000))
+metric_stream_chunks_total = metrics.counter('cursor2api_sse_chunks_total', 'SSE chunks sent across all streams')
+metric_intents = metrics.counter('cursor2api_intent_total', 'Responses by generator branch', ('intent',))
+metric_errors = metrics.counter('cursor2api_errors_total', 'Error responses by status code', ('code',))
+
+class PhaseTimer:
+    """
+    请求各阶段耗时
+    mark(name) 记录自上一次 mark 以来的耗时，开销仅为一次 perf_counter 调用；
+    结果以 Server-Timing 格式输出，或在请求结束时记入慢请求日志
+    """
+    
+    __slots__ = ('started', 'last', 'phases')
+    
+    def __init__(self):
+        self.started = self.last = time.perf_counter()
+        self.phases = []
+    
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+    
+    def elapsed(self):
+        return time.perf_counter() - self.started
+    
+    def header(self):
+        """Server-Timing 头的值（毫秒）"""
+        parts = [f'{name};dur={seconds * 1000:.3f}' for name, seconds in self.phases]
+        parts.append(f'total;dur={(self.last - self.started) * 1000:.3f}')
+        return ', '.join(parts)
+    
+    def log_if_slow(self, **fields):
+        """总耗时超过 SLOW_REQUEST_THRESHOLD 时按采样率输出一行结构化日志"""
+        total = self.elapsed()
+        if total < SLOW_REQUEST_THRESHOLD or random.random() >= SLOW_REQUEST_SAMPLE_RATE:
+            return
+        record = {'event': 'slow_request', 'total_ms': round(total * 1000, 3)}
+        record.update(fields)
+        record['phases'] = {name: round(seconds * 1000, 3) for name, seconds in self.phases}
+        print(json_codec.dumps(record), file=sys.stderr)
+
+class MathError(ValueError):
+    """算术表达式超出限制或无法计算"""
+
+class InvalidExpressionError(MathError):
+    """输入不是合法的算术表达式"""
+
+class MathTimeout(MathError):
+    """求值超过 CPU 时间限制（与当时的负载有关，同一表达式重试可能成功）"""
+
+class ArithmeticEngine:
+    """
+    受限的算术表达式求值器，用于替代 eval
+    - 表达式只解析一次为 AST 并校验，编译结果按表达式字符串缓存
+    - 只允许数字字面量、括号与 + - * / // % ** 运算
+    - 求值时限制表达式长度、节点数、数值位数、指数大小与 CPU 时间，超限抛出 MathError（超时为 MathTimeout）
+    """
+    
+    BINARY_OPERATORS = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv,
+        ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod,
+        ast.Pow: operator.pow,
+    }
+    UNARY_OPERATORS = {
+        ast.UAdd: operator.pos,
+        ast.USub: operator.neg,
+    }
+    # Python 3.8 之前数字字面量是 ast.Num
+    NUMBER_NODES = (ast.Constant,) if sys.version_info >= (3, 8) else (ast.Constant, ast.Num)
+    
+    def __init__(self, max_length=1000, max_nodes=256, max_digits=1000, max_exponent=10000,
+                 time_limit=0.05, cache_size=1024):
+        self.max_length = max_length
+        self.max_nodes = max_nodes
+        self.max_digits = max_digits
+        self.max_magnitude = 10 ** max_digits
+        self.max_exponent = max_exponent
+        self.time_limit = time_limit
+        self._compile = functools.lru_cache(maxsize=cache_size)(self._compile_uncached)
+    
+    def _compile_uncached(self, expression):
+        if len(expression) > self.max_length:
+            raise MathError('表达式过长')
+        try:
+            tree = ast.parse(expression, mode='eval')
+        except (SyntaxError, ValueError):
+            raise InvalidExpressionError('不是有效的算术表达式')
+        nodes = 0
+        for node in ast.walk(tree.body):
+            nodes += 1
+            if nodes > self.max_nodes:
+                raise MathError('表达式过于复杂')
+            if isinstance(node, ast.BinOp):
+                if type(node.op) not in self.BINARY_OPERATORS:
+                    raise MathError('不支持的运算符')
+            elif isinstance(node, ast.UnaryOp):
+                if type(node.op) not in self.UNARY_OPERATORS:
+                    raise MathError('不支持的运算符')
+            elif isinstance(node, self.NUMBER_NODES):
+                value = getattr(node, 'value', getattr(node, 'n', None))
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    raise InvalidExpressionError('不是有效的算术表达式')
+            elif not isinstance(node, (ast.operator, ast.unaryop)):
+                raise InvalidExpressionError('不是有效的算术表达式')
+        return tree.body
+    
+    def evaluate(self, expression):
+        """计算表达式，结果为 int 或 float"""
+        node = self._compile(expression.strip())
+        deadline = time.thread_time() + self.time_limit
+        return self._eval(node, deadline)
+    
+    def _check(self, value):
+        if isinstance(value, complex):
+            raise MathError('结果不是实数')
+        if abs(value) >= self.max_magnitude:
+            raise MathError(f'结果超过 {self.max_digits} 位')
+        return value
+    
+    def _eval(self, node, deadline):
+        if time.thread_time() > deadline:
+            raise MathTimeout('计算超时')
+        if isinstance(node, self.NUMBER_NODES):
+            return self._check(getattr(node, 'value', getattr(node, 'n', None)))
+        if isinstance(node, ast.UnaryOp):
+            return self.UNARY_OPERATORS[type(node.op)](self._eval(node.operand, deadline))
+        
+        left = self._eval(node.left, deadline)
+        right = self._eval(node.right, deadline)
+        if isinstance(node.op, ast.Pow):
+            self._check_power(left, right)
+        try:
+            result = self.BINARY_OPERATORS[type(node.op)](left, right)
+        except ZeroDivisionError:
+            raise MathError('除数不能为零')
+        except OverflowError:
+            raise MathError('结果超出范围')
+        return self._check(result)
+    
+    def _check_power(self, base, exponent):
+        # 在真正计算之前估算结果位数，避免 9**9**9 这类表达式耗尽 CPU
+        if abs(exponent) > self.max_exponent:
+            raise MathError('指数过大')
+        if isinstance(base, int) and isinstance(exponent, int) and exponent > 0 and abs(base) > 1:
+            if math.log10(abs(base)) * exponent >= self.max_digits:
+                raise MathError(f'结果超过 {self.max_digits} 位')
+
+math_engine = ArithmeticEngine()
+
+def strip_math_words(message):
+    """移除常见的问题词汇，得到算术表达式部分"""
+    cleaned = message.replace('?', '').replace('=', '').replace('？', '')
     cleaned = cleaned.replace('等于多少', '').replace('等于', '').replace('是多少', '')
     cleaned = cleaned.replace('equals', '').replace('what is', '').replace('calculate', '')
-    cleaned = cleaned.strip()
+    return cleaned.strip()
+
+def process_math(message):
+    """
+    处理数学计算
+    不是算术表达式时返回 None；表达式超出计算限制时抛出 MathError
+    """
+    # 清理输入 - 移除常见的问题词汇
+    cleaned = strip_math_words(message)
     
     # 检查是否为数学表达式
     if re.match(r'^[\d\s\+\-\*\/\(\)\.]+$', cleaned):
         try:
-            result = eval(cleaned, {"__builtins__": {}})
-            if isinstance(result, float) and result.is_integer():
-                result = int(result)
-            return str(result)
-        except:
-            pass
+            result = math_engine.evaluate(cleaned)
+        except InvalidExpressionError:
+            return None
+        if isinstance(result, float) and result.is_integer():
+            result = int(result)
+        return str(result)
     return None
 
-def clean_old_sessions():
-    """清理过期的会话"""
-    current_time = datetime.now()
-    expired_sessions = []
+# 会话中的事实索引：在追加对话时提取一次，回忆类问题直接查询，不必回溯对话历史，
+# 对话滚出最近 SESSION_HISTORY_SIZE 轮之后事实仍然保留。
+#   memory: 用户最近一次要求记住的内容；memory_quoted 为 True 时 memory 为整句原话（消息中没有冒号分隔的内容）
+#   name: 用户最近一次告诉的名字；number: 最近一次含数字的回复中的最后一个数字
+SessionFacts = namedtuple('SessionFacts', ['memory', 'memory_quoted', 'name', 'number'])
+EMPTY_FACTS = SessionFacts(None, False, None, None)
+
+NAME_PATTERN = re.compile(r'我叫(\S+)')
+NUMBER_PATTERN = re.compile(r'\d+')
+
+def is_recall_question(message, hits):
+    """是否为询问记住的内容或名字的问题，这类消息本身不作为事实记录"""
+    asks = "什么" in hits or "?" in message or "？" in message
+    return asks and ("记住" in hits or "叫什么" in hits or "名字" in hits)
+
+def extract_user_facts(facts, message):
+    """提取用户消息中的事实，返回新的 SessionFacts（没有新事实时返回 facts 本身）"""
+    if not isinstance(message, str) or not message:
+        return facts
+    msg_lower = message.lower()
+    if is_recall_question(message, intent_matcher.match(msg_lower)):
+        return facts
+    
+    if "记住" in msg_lower or "记得" in msg_lower:
+        # 冒号后的内容为要记住的内容，否则记住整句
+        for colon in ('：', ':'):
+            if colon in message:
+                facts = facts._replace(memory=message.split(colon)[1].strip(), memory_quoted=False)
+                break
+        else:
+            facts = facts._replace(memory=message, memory_quoted=True)
+    
+    name_match = NAME_PATTERN.search(message)
+    if name_match:
+        facts = facts._replace(name=name_match.group(1))
+    elif "：" in message and "名字" in message:
+        facts = facts._replace(name=message.split('：')[1].split('，')[0].strip())
+    return facts
+
+def extract_reply_facts(facts, reply):
+    """提取回复中的最后一个数字"""
+    if not isinstance(reply, str):
+        return facts
+    numbers = NUMBER_PATTERN.findall(reply)
+    return facts._replace(number=numbers[-1]) if numbers else facts
+
+def extract_facts(facts, exchange):
+    """把一轮对话 {'user', 'assistant'} 中的事实合并进 facts"""
+    facts = extract_user_facts(facts, exchange.get('user', ''))
+    return extract_reply_facts(facts, exchange.get('assistant', ''))
+
+def facts_from_history(history):
+    """从对话历史重建事实索引（用于没有保存事实的旧数据）"""
+    facts = EMPTY_FACTS
+    for exchange in history:
+        facts = extract_facts(facts, exchange)
+    return facts
+
+def merge_facts(older, newer):
+    """合并两个来源的事实，newer 中已有的字段优先"""
+    if older is EMPTY_FACTS:
+        return newer
+    if newer is EMPTY_FACTS:
+        return older
+    memory, memory_quoted = (newer.memory, newer.memory_quoted) if newer.memory is not None \
+        else (older.memory, older.memory_quoted)
+    return SessionFacts(memory, memory_quoted,
+                        newer.name if newer.name is not None else older.name,
+                        newer.number if newer.number is not None else older.number)
+
+def encode_facts(facts):
+    return facts._asdict()
+
+def decode_facts(data):
+    """从存储或导入的 dict 还原 SessionFacts，格式不符时返回 None（由调用方从历史重建）"""
+    if not isinstance(data, dict):
+        return None
+    memory, name, number = data.get('memory'), data.get('name'), data.get('number')
+    if not all(value is None or isinstance(value, str) for value in (memory, name, number)):
+        return None
+    return SessionFacts(memory, bool(data.get('memory_quoted')), name, number)
+
+class SessionBackend:
+    """
+    会话持久化后端接口
+    SessionStore 在进程内缓存未命中或过期时调用 load()，每轮对话调用 append()
+    """
+    
+    def load(self, session_id):
+        """返回 (last_access, history, facts)，不存在时返回 None；facts 为 None 表示未保存过事实索引"""
+        return None
+    
+    def append(self, session_id, last_access, exchange, facts):
+        """追加一轮对话，facts 为追加后的事实索引"""
+    
+    def purge(self, cutoff):
+        """删除最后访问时间早于 cutoff 的会话"""
+    
+    def items(self):
+        """遍历 (session_id, last_access, history, facts)"""
+        return iter(())
     
-    for session_id, last_access in session_last_access.items():
-        if (current_time - last_access).total_seconds() > MAX_SESSION_AGE:
-            expired_sessions.append(session_id)
+    def restore_many(self, records):
+        """批量写入 (session_id, last_access, history, facts)，覆盖已有会话"""
     
-    for session_id in expired_sessions:
-        if session_id in conversation_memory:
-            del conversation_memory[session_id]
-        del session_last_access[session_id]
+    def flush(self):
+        """提交所有待写入的数据"""
+    
+    def close(self):
+        """释放资源"""
+
+class SQLiteSessionBackend(SessionBackend):
+    """
+    基于 SQLite（WAL 模式）的会话后端
+    - 对话以追加方式写入 exchanges 表，多个工作进程并发写同一会话也不会互相覆盖
+    - 写入先进入待写队列，由后台线程按批次在单个事务中提交
+    - 读取时合并尚未提交的待写数据，保证本进程读到自己的写入
+    - 每个会话的事实索引保存在 facts 表（每个会话一行，随对话一起提交）
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions(last_access);
+        CREATE TABLE IF NOT EXISTS exchanges (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS exchanges_session ON exchanges(session_id, id);
+        CREATE TABLE IF NOT EXISTS facts (
+            session_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+    """
+    
+    def __init__(self, path=SESSION_DB_PATH, history_size=SESSION_HISTORY_SIZE,
+                 flush_interval=0.2, batch_size=256, purge_interval=60.0):
+        self.path = path
+        self.history_size = history_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.purge_interval = purge_interval
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self.SCHEMA)
+        self._db_lock = threading.Lock()
+        self._pending = []  # [(session_id, last_access, exchange, facts)]
+        self._inflight = []  # 已从 _pending 取出、正在提交的批次，提交完成前对 load() 仍然可见
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher = None
+        self._last_purge = 0.0
+        self._closed = False
+        atexit.register(self.close)
+    
+    def _ensure_flusher(self):
+        # 延迟到首次写入时再启动线程，避免 fork 前创建线程
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_loop, name='session-flusher',
+                                             daemon=True)
+            self._flusher.start()
+    
+    def _flush_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                # 失败的批次已放回待写队列，下一轮重试
+                print(f"会话写入失败，稍后重试: {e}", file=sys.stderr)
+    
+    def load(self, session_id):
+        with self._db_lock:
+            row = self._conn.execute(
+                'SELECT last_access FROM sessions WHERE session_id = ?', (session_id,)
+            ).fetchone()
+            rows = self._conn.execute(
+                'SELECT data FROM exchanges WHERE session_id = ? ORDER BY id DESC LIMIT ?',
+                (session_id, self.history_size)
+            ).fetchall()
+            facts_row = self._conn.execute(
+                'SELECT data FROM facts WHERE session_id = ?', (session_id,)
+            ).fetchone()
+            # 仍持有 _db_lock 时取待写快照：正在提交的批次要么已在库中，要么仍在 _inflight 中，
+            # 既不会遗漏也不会与库中的数据重复
+            with self._pending_lock:
+                pending = [(ts, ex, f) for sid, ts, ex, f in self._inflight + self._pending
+                           if sid == session_id]
+        last_access = row[0] if row else None
+        history = [json_codec.decode(data) for (data,) in reversed(rows)]
+        facts = decode_facts(json_codec.decode(facts_row[0])) if facts_row else None
+        for ts, exchange, pending_facts in pending:
+            history.append(exchange)
+            facts = pending_facts
+            last_access = ts if last_access is None else max(last_access, ts)
+        if last_access is None:
+            return None
+        return last_access, history[-self.history_size:], facts
+    
+    def append(self, session_id, last_access, exchange, facts):
+        with self._pending_lock:
+            self._pending.append((session_id, last_access, exchange, facts))
+            full = len(self._pending) >= self.batch_size
+        self._ensure_flusher()
+        if full:
+            self._wakeup.set()
+    
+    def flush(self):
+        # 后台线程与关闭流程可能同时调用，逐个执行以免覆盖彼此的 _inflight
+        with self._flush_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, []
+                self._inflight = batch
+            if not batch:
+                return
+            try:
+                self._write_batch(batch)
+            except BaseException:
+                # 放回队首，保持与之后追加的对话的先后顺序
+                with self._pending_lock:
+                    self._pending[:0] = batch
+                    self._inflight = []
+                raise
+    
+    def _write_batch(self, batch):
+        touched = {}
+        latest_facts = {}
+        for session_id, last_access, _, facts in batch:
+            touched[session_id] = max(last_access, touched.get(session_id, 0.0))
+            latest_facts[session_id] = facts
+        with self._db_lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany(
+                    'INSERT INTO exchanges (session_id, data) VALUES (?, ?)',
+                    [(sid, json_codec.dumps(ex)) for sid, _, ex, _ in batch]
+                )
+                self._conn.executemany(
+                    'INSERT INTO facts (session_id, data) VALUES (?, ?) '
+                    'ON CONFLICT(session_id) DO UPDATE SET data = excluded.data',
+                    [(sid, json_codec.dumps(encode_facts(facts))) for sid, facts in latest_facts.items()]
+                )
+                self._conn.executemany(
+                    'INSERT INTO sessions (session_id, last_access) VALUES (?, ?) '
+                    'ON CONFLICT(session_id) DO UPDATE SET '
+                    'last_access = max(last_access, excluded.last_access)',
+                    list(touched.items())
+                )
+                # 每个会话只保留最近 history_size 轮
+                self._conn.executemany(
+                    'DELETE FROM exchanges WHERE session_id = ? AND id <= ('
+                    'SELECT id FROM exchanges WHERE session_id = ? '
+                    'ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                    [(sid, sid, self.history_size) for sid in touched]
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            # 与提交处于同一段 _db_lock 内，load() 不会看到已提交但仍在 _inflight 中的批次
+            with self._pending_lock:
+                self._inflight = []
+    
+    def purge(self, cutoff):
+        now = time.time()
+        if now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        with self._db_lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute(
+                    'DELETE FROM exchanges WHERE session_id IN '
+                    '(SELECT session_id FROM sessions WHERE last_access < ?)', (cutoff,)
+                )
+                self._conn.execute(
+                    'DELETE FROM facts WHERE session_id IN '
+                    '(SELECT session_id FROM sessions WHERE last_access < ?)', (cutoff,)
+                )
+                self._conn.execute('DELETE FROM sessions WHERE last_access < ?', (cutoff,))
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+    
+    def items(self, page_size=500):
+        # 按主键分页遍历，内存占用与会话总数无关
+        self.flush()
+        after = ''
+        while True:
+            with self._db_lock:
+                sessions = self._conn.execute(
+                    'SELECT session_id, last_access FROM sessions WHERE session_id > ? '
+                    'ORDER BY session_id LIMIT ?', (after, page_size)
+                ).fetchall()
+            if not sessions:
+                return
+            for session_id, last_access in sessions:
+                record = self.load(session_id)
+                if record is not None:
+                    yield session_id, last_access, record[1], record[2]
+            after = sessions[-1][0]
+    
+    def restore_many(self, records):
+        self.flush()
+        with self._db_lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany(
+                    'DELETE FROM exchanges WHERE session_id = ?',
+                    [(sid,) for sid, _, _, _ in records]
+                )
+                self._conn.executemany(
+                    'INSERT INTO exchanges (session_id, data) VALUES (?, ?)',
+                    [(sid, json_codec.dumps(ex))
+                     for sid, _, history, _ in records for ex in history[-self.history_size:]]
+                )
+                self._conn.executemany(
+                    'INSERT INTO sessions (session_id, last_access) VALUES (?, ?) '
+                    'ON CONFLICT(session_id) DO UPDATE SET last_access = excluded.last_access',
+                    [(sid, last_access) for sid, last_access, _, _ in records]
+                )
+                self._conn.executemany(
+                    'INSERT INTO facts (session_id, data) VALUES (?, ?) '
+                    'ON CONFLICT(session_id) DO UPDATE SET data = excluded.data',
+                    [(sid, json_codec.dumps(encode_facts(facts))) for sid, _, _, facts in records]
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+    
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        try:
+            self.flush()
+        finally:
+            with self._db_lock:
+                self._conn.close()
+
+def create_session_backend(name=SESSION_BACKEND):
+    """按名称创建会话后端，memory 表示不持久化"""
+    if name in ('', 'memory'):
+        return None
+    if name == 'sqlite':
+        return SQLiteSessionBackend(SESSION_DB_PATH)
+    raise ValueError(f'未知的会话后端: {name}')
+
+class Session:
+    """单个会话：最后访问时间、最近的对话历史与事实索引"""
+    __slots__ = ('last_access', 'history', 'facts', 'loaded_at')
+    
+    def __init__(self, last_access, history=(), history_size=SESSION_HISTORY_SIZE, facts=None):
+        self.last_access = last_access
+        self.history = deque(history, maxlen=history_size)
+        self.facts = facts if facts is not None else facts_from_history(self.history)
+        self.loaded_at = last_access
+
+class SessionStore:
+    """
+    线程安全的会话存储
+    - 按 session_id 哈希分片加锁，不同分片的请求互不阻塞
+    - 每个分片的 OrderedDict 按最后访问时间排序。所有会话存活时间相同，
+      所以队首就是最早过期的会话：清理过期会话与 LRU 淘汰都只需从队首弹出，
+      单次请求的开销与会话总数无关
+    - 会话总数上限按分片均分，每个分片独立执行 LRU 淘汰
+    - 配置了 backend 时作为其读穿透缓存：缓存超过 cache_ttl 后重新从后端读取，
+      以便看到其他工作进程写入的对话
+    """
+    
+    def __init__(self, max_age=MAX_SESSION_AGE, max_sessions=MAX_SESSIONS,
+                 history_size=SESSION_HISTORY_SIZE, stripes=16, purge_interval=1.0,
+                 backend=None, cache_ttl=SESSION_CACHE_TTL):
+        self.max_age = max_age
+        self.history_size = history_size
+        self.stripe_capacity = max(1, -(-max_sessions // stripes))
+        self.purge_interval = purge_interval
+        self.backend = backend
+        self.cache_ttl = cache_ttl
+        self._stripes = [(threading.Lock(), OrderedDict()) for _ in range(stripes)]
+        self._last_purge = 0.0
+    
+    def _stripe(self, session_id):
+        return self._stripes[hash(session_id) % len(self._stripes)]
+    
+    def _insert(self, sessions, session_id, now, history=(), facts=None):
+        session = sessions[session_id] = Session(now, history, self.history_size, facts)
+        while len(sessions) > self.stripe_capacity:
+            sessions.popitem(last=False)
+        return session
+    
+    def touch(self, session_id, now=None):
+        """更新会话访问时间（不存在则创建），返回会话的事实索引（SessionFacts，不可变，无需复制）"""
+        now = time.time() if now is None else now
+        lock, sessions = self._stripe(session_id)
+        with lock:
+            session = sessions.get(session_id)
+            if session is not None and (self.backend is None or now - session.loaded_at < self.cache_ttl):
+                session.last_access = now
+                sessions.move_to_end(session_id)
+                return session.facts
+        
+        # 缓存未命中：在锁外读取后端
+        record = self.backend.load(session_id) if self.backend is not None else None
+        if record is not None and record[0] <= now - self.max_age:
+            record = None
+        with lock:
+            session = sessions.get(session_id)
+            if session is None:
+                session = self._insert(sessions, session_id, now)
+            if record is not None:
+                session.history = deque(record[1], maxlen=self.history_size)
+                session.facts = record[2] if record[2] is not None else facts_from_history(session.history)
+            session.loaded_at = now
+            session.last_access = now
+            sessions.move_to_end(session_id)
+            return session.facts
+    
+    def append(self, session_id, exchange, now=None):
+        """向会话追加一轮对话，并更新事实索引"""
+        now = time.time() if now is None else now
+        lock, sessions = self._stripe(session_id)
+        with lock:
+            session = sessions.get(session_id)
+            if session is None:
+                session = self._insert(sessions, session_id, now)
+            session.last_access = now
+            sessions.move_to_end(session_id)
+            session.history.append(exchange)
+            session.facts = facts = extract_facts(session.facts, exchange)
+        if self.backend is not None:
+            self.backend.append(session_id, now, exchange, facts)
+    
+    def get(self, session_id):
+        """返回 (last_access, history) 快照，会话不存在时返回 None"""
+        lock, sessions = self._stripe(session_id)
+        with lock:
+            session = sessions.get(session_id)
+            if session is None:
+                return None
+            return session.last_access, list(session.history)
+    
+    def purge_expired(self, now=None, force=False):
+        """清理过期会话；默认每 purge_interval 秒最多执行一次"""
+        now = time.time() if now is None else now
+        if not force and now - self._last_purge < self.purge_interval:
+            return 0
+        self._last_purge = now
+        cutoff = now - self.max_age
+        purged = 0
+        for lock, sessions in self._stripes:
+            with lock:
+                while sessions:
+                    session_id, session = next(iter(sessions.items()))
+                    if session.last_access > cutoff:
+                        break
+                    sessions.popitem(last=False)
+                    purged += 1
+        if self.backend is not None:
+            self.backend.purge(cutoff)
+        return purged
+    
+    def restore_many(self, records, now=None):
+        """
+        批量导入 (session_id, last_access, history, facts)，覆盖同名会话
+        facts 为 None 时从 history 重建；已过期的记录会被跳过，返回实际导入的数量。
+        导入的 last_access 可能早于分片中已有的会话，写入后按 last_access 重排受影响的分片，
+        保持队首最早过期的顺序，再执行 LRU 淘汰
+        """
+        now = time.time() if now is None else now
+        cutoff = now - self.max_age
+        by_stripe = {}
+        for record in records:
+            if record[1] > cutoff:
+                stripe = self._stripe(record[0])
+                by_stripe.setdefault(id(stripe), (stripe, []))[1].append(record)
+        restored = []
+        for (lock, sessions), stripe_records in by_stripe.values():
+            with lock:
+                for session_id, last_access, history, facts in stripe_records:
+                    session = Session(last_access, history, self.history_size, facts)
+                    session.loaded_at = now
+                    sessions.pop(session_id, None)
+                    sessions[session_id] = session
+                    restored.append((session_id, last_access, history, session.facts))
+                ordered = sorted(sessions.items(), key=lambda item: item[1].last_access)
+                sessions.clear()
+                sessions.update(ordered)
+                while len(sessions) > self.stripe_capacity:
+                    sessions.popitem(last=False)
+        if self.backend is not None and restored:
+            self.backend.restore_many(restored)
+        return len(restored)
+    
+    def items(self):
+        """
+        遍历 (session_id, last_access, history, facts) 快照
+        配置了后端时以后端为准，否则逐个分片复制进程内数据
+        """
+        if self.backend is not None:
+            for item in self.backend.items():
+                yield item
+            return
+        for lock, sessions in self._stripes:
+            with lock:
+                snapshot = [(sid, s.last_access, list(s.history), s.facts) for sid, s in sessions.items()]
+            for item in snapshot:
+                yield item
+    
+    def __len__(self):
+        return sum(len(sessions) for _, sessions in self._stripes)
+    
+    def memory_stats(self):
+        """返回进程内 (会话数, 对话轮数, 对话文本字符数)，逐个分片统计"""
+        count = exchanges = chars = 0
+        for lock, sessions in self._stripes:
+            with lock:
+                for session in sessions.values():
+                    count += 1
+                    exchanges += len(session.history)
+                    for exchange in session.history:
+                        chars += len(exchange.get('user', '')) + len(exchange.get('assistant', ''))
+        return count, exchanges, chars
+    
+    def __contains__(self, session_id):
+        lock, sessions = self._stripe(session_id)
+        with lock:
+            return session_id in sessions
+    
+    def clear(self):
+        for lock, sessions in self._stripes:
+            with lock:
+                sessions.clear()
+    
+    def close(self):
+        """提交并关闭持久化后端"""
+        if self.backend is not None:
+            self.backend.close()
+
+session_store = SessionStore(backend=create_session_backend())
+
+def shutdown():
+    """
+    进程退出前调用：提交尚未写入后端的对话
+    pre-fork 工作进程以 os._exit 退出、SIGTERM 默认直接终止进程，都不会执行 atexit 注册的清理
+    """
+    session_store.close()
+
+def clean_old_sessions():
+    """清理过期的会话"""
+    session_store.purge_expired()
 
 def get_session_id(auth_header, user_agent="", request_body=None):
     """
@@ -91,132 +1131,694 @@ def get_session_id(auth_header, user_agent="", request_body=None):
     # 这样使用同一个 API KEY 的所有请求都会共享会话历史
     return hashlib.md5(auth_header.encode()).hexdigest()
 
+def _trie_pattern(words):
+    """把关键词集合编译为按前缀树组织的正则，同一位置总是匹配最长的关键词"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            return '(?:' + body + ')?' if len(branches) == 1 else body + '?'
+        return body
+    
+    return build(trie)
+
+class KeywordMatcher:
+    """
+    多模式关键词匹配器
+    导入时把所有关键词表编译为一个前缀树正则，一次扫描即可得到消息中出现的全部关键词，
+    结果与逐个执行 `word in text` 一致。正则匹配互不重叠，因此：
+    - 包含在已匹配关键词内部的关键词（如 "javascript" 中的 "java"、"this" 中的 "hi"）在编译时展开
+    - 可能跨越两次匹配边界出现的少数关键词（如 "hit" 中的 "it"）未命中时再单独查找
+    """
+    
+    def __init__(self, *tables):
+        self.keywords = frozenset(word for table in tables for word in table)
+        self._pattern = re.compile(_trie_pattern(self.keywords))
+        self._implied = {
+            kw: frozenset(k for k in self.keywords if k in kw) for kw in self.keywords
+        }
+        self._straddling = frozenset(
+            k for k in self.keywords
+            if any(len(other) > i and other.endswith(k[:i])
+                   for other in self.keywords for i in range(1, len(k)))
+        )
+    
+    def match(self, text):
+        """返回 text 中出现的全部关键词"""
+        hits = set()
+        for keyword in set(self._pattern.findall(text)):
+            hits |= self._implied[keyword]
+        for keyword in self._straddling - hits:
+            if keyword in text:
+                hits.add(keyword)
+        return hits
+
+# generate_intelligent_response 使用的关键词表
+CONTEXT_WORDS = frozenset(["这个", "那个", "刚才", "上面", "之前", "记住", "什么", "it", "that", "this", "what"])
+MATH_REFERENCE_WORDS = frozenset(["结果", "答案", "这个数", "那个数", "乘", "加", "减", "除"])
+MATH_OPERATOR_WORDS = frozenset(["乘", "加", "减", "除", "*", "+", "-", "/"])
+GREETINGS = {
+    "hello": "Hello! How can I assist you today?",
+    "hi": "Hi there! What can I help you with?",
+    "你好": "你好！有什么我可以帮助您的吗？",
+    "您好": "您好！请问需要什么帮助？",
+}
+IDENTITY_WORDS = frozenset(["你是谁", "who are you", "介绍一下你", "introduce yourself"])
+PROGRAMMING_WORDS = frozenset(["python", "javascript", "java", "code", "代码", "编程"])
+TIME_WORDS = frozenset(["时间", "time", "几点", "日期", "date"])
+WEATHER_WORDS = frozenset(["天气", "weather", "温度", "temperature"])
+TRANSLATE_WORDS = frozenset(["翻译", "translate", "translation"])
+QUESTION_WORDS = frozenset(["什么", "如何", "为什么", "怎么", "what", "how", "why"])
+
+intent_matcher = KeywordMatcher(
+    CONTEXT_WORDS, MATH_REFERENCE_WORDS, MATH_OPERATOR_WORDS, GREETINGS, IDENTITY_WORDS,
+    PROGRAMMING_WORDS, TIME_WORDS, WEATHER_WORDS, TRANSLATE_WORDS, QUESTION_WORDS,
+    ["叫什么", "名字"]
+)
+
+class ResponseCache:
+    """
+    线程安全的 LRU + TTL 响应缓存
+    超过 max_size 时淘汰最久未使用的条目，条目在 ttl 秒后过期
+    """
+    
+    def __init__(self, max_size=4096, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+    
+    def get(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, key, value, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+def response_cache_key(model, user_message):
+    """缓存键：模型与当前消息的摘要"""
+    return hashlib.blake2b(f"{model}\0{user_message}".encode(), digest_size=16).digest()
+
+# 回复随时间或负载变化的分支不缓存（math_timeout 为求值超时，空闲时重试可能得到结果）
+UNCACHEABLE_INTENTS = frozenset(["time", "math_timeout"])
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL) if RESPONSE_CACHE_SIZE > 0 else None
+
+# 中日韩文字与全角标点（不以空格分词，分词与计数时按单字处理）
+CJK_CHARS = '\u2e80-\u2fff\u3000-\u9fff\uac00-\ud7af\uf900-\ufaff\ufe30-\ufe4f\uff00-\uffef'
+
+# 分词器近似参数：
+#   cjk: 每个中日韩字符的 token 数；chars_per_token: 拉丁字母单词每个 token 的字母数；
+#   digits_per_token: 连续数字每个 token 的位数；bytes_per_token: 其它非 ASCII 字符（西里尔、emoji 等）每个 token 的 UTF-8 字节数；
+#   message_overhead: 每条消息的格式开销（含 role）；reply_overhead: 回复引导开销；encoding: 对应的 tiktoken 编码
+TokenProfile = namedtuple('TokenProfile', [
+    'name', 'cjk', 'chars_per_token', 'digits_per_token', 'bytes_per_token',
+    'message_overhead', 'reply_overhead', 'encoding'
+])
+
+TOKEN_PROFILES = {
+    'cl100k': TokenProfile('cl100k', 1.2, 4, 3, 2, 4, 3, 'cl100k_base'),
+    'o200k': TokenProfile('o200k', 0.8, 4, 3, 2.5, 4, 3, 'o200k_base'),
+    'claude': TokenProfile('claude', 1.1, 3.5, 3, 2, 5, 3, None),
+    'gemini': TokenProfile('gemini', 0.8, 4, 1, 2.5, 4, 3, None),
+    'deepseek': TokenProfile('deepseek', 0.6, 3.3, 3, 2, 4, 3, None),
+    'generic': TokenProfile('generic', 1.0, 4, 3, 2, 4, 3, None),
+}
+
+# 模型名前缀 -> 分词器（按最长前缀匹配），未匹配的模型使用 generic
+MODEL_TOKEN_PROFILES = {
+    'gpt-5': 'o200k', 'gpt-4.1': 'o200k', 'gpt-4o': 'o200k', 'o3': 'o200k', 'o4': 'o200k',
+    'gpt-4': 'cl100k', 'gpt-3.5': 'cl100k',
+    'claude': 'claude',
+    'gemini': 'gemini',
+    'deepseek': 'deepseek',
+    'text-embedding': 'cl100k',
+}
+
+TOKEN_CJK_PATTERN = re.compile(f'[{CJK_CHARS}]')
+TOKEN_WORD_PATTERN = re.compile(r'[A-Za-z]+')
+TOKEN_DIGIT_PATTERN = re.compile(r'[0-9]+')
+TOKEN_PUNCT_PATTERN = re.compile(r'[!-/:-@\[-`{-~]+')
+TOKEN_OTHER_PATTERN = re.compile(f'[^\x00-\x7f{CJK_CHARS}]+')
+
+def approx_token_count(text, profile):
+    """
+    按文字类别近似 BPE 分词的 token 数：
+    CJK 按字计，拉丁单词按长度计（常见短词为 1 个），数字按位数分组，连续标点约每两个字符 1 个，
+    其它非 ASCII 文字按 UTF-8 字节计，空白并入相邻 token 不单独计数
+    """
+    if not text:
+        return 0
+    cjk = len(TOKEN_CJK_PATTERN.findall(text))
+    # 单词长度 <= 2 * chars_per_token - 1 时视为 1 个 token，更长的按字母数线性增加
+    per = profile.chars_per_token
+    words = sum(1 + int(max(0, len(w) - per) // per) for w in TOKEN_WORD_PATTERN.findall(text))
+    digits = sum(-(-len(d) // profile.digits_per_token) for d in TOKEN_DIGIT_PATTERN.findall(text))
+    punct = sum((len(p) + 1) // 2 for p in TOKEN_PUNCT_PATTERN.findall(text))
+    other = sum(len(o.encode('utf-8', 'surrogatepass')) for o in TOKEN_OTHER_PATTERN.findall(text))
+    return int(cjk * profile.cjk + other / profile.bytes_per_token + 0.5) + words + digits + punct
+
+class TokenCounter:
+    """
+    token 计数器
+    按模型选择分词器参数，计数结果按内容摘要缓存（LRU），重复发送的长消息只计数一次；
+    backend 为 tiktoken 且已安装时，对有对应编码的模型使用 tiktoken 精确计数
+    """
+    
+    # 短文本直接计数比计算摘要更快，不进入缓存
+    MIN_CACHED_LENGTH = 256
+    
+    def __init__(self, backend='approx', cache_size=8192):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # (分词器名, 内容摘要) -> token 数
+        self._lock = threading.Lock()
+        self._profiles = {}
+        self._encodings = {}
+        self.backend = 'approx'
+        if backend == 'tiktoken':
+            try:
+                import tiktoken
+                self._tiktoken = tiktoken
+                self.backend = 'tiktoken'
+            except ImportError:
+                print("TOKEN_COUNTER=tiktoken 但未安装 tiktoken，使用内置近似计数", file=sys.stderr)
+        elif backend != 'approx':
+            print(f"未知的 TOKEN_COUNTER: {backend}，使用内置近似计数", file=sys.stderr)
+        for model in MODELS:
+            self.profile(model)
+    
+    def profile(self, model):
+        """返回模型对应的 TokenProfile"""
+        profile = self._profiles.get(model)
+        if profile is None:
+            name = 'generic'
+            for prefix in sorted(MODEL_TOKEN_PROFILES, key=len, reverse=True):
+                if str(model).startswith(prefix):
+                    name = MODEL_TOKEN_PROFILES[prefix]
+                    break
+            profile = TOKEN_PROFILES[name]
+            if len(self._profiles) < 1024:  # 未知模型名由客户端提供，限制数量
+                self._profiles[model] = profile
+        return profile
+    
+    def _encode_count(self, text, profile):
+        if self.backend == 'tiktoken' and profile.encoding:
+            encoding = self._encodings.get(profile.encoding)
+            if encoding is None:
+                encoding = self._encodings[profile.encoding] = self._tiktoken.get_encoding(profile.encoding)
+            return len(encoding.encode(text, disallowed_special=()))
+        return approx_token_count(text, profile)
+    
+    def count(self, text, profile):
+        """计算文本的 token 数，profile 为 TokenProfile 或模型名"""
+        if not isinstance(profile, TokenProfile):
+            profile = self.profile(profile)
+        if not isinstance(text, str):
+            text = json_codec.dumps(text)
+        if len(text) < self.MIN_CACHED_LENGTH or self.cache_size <= 0:
+            return self._encode_count(text, profile)
+        key = (profile.name, hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest())
+        with self._lock:
+            tokens = self._cache.get(key)
+            if tokens is not None:
+                self._cache.move_to_end(key)
+                return tokens
+        tokens = self._encode_count(text, profile)
+        with self._lock:
+            self._cache[key] = tokens
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return tokens
+    
+    def count_message(self, message, profile):
+        """单条消息的 token 数（内容 + 格式开销）"""
+        tokens = profile.message_overhead + self.count(message.get('content', ''), profile)
+        if message.get('name'):
+            tokens += 1
+        return tokens
+
+token_counter = TokenCounter(TOKEN_COUNTER, TOKEN_CACHE_SIZE)
+
+# 嵌入模型：模型名 -> (默认维度, 是否支持 dimensions 参数)，与 OpenAI 一致
+EMBEDDING_MODELS = {
+    "text-embedding-3-small": (1536, True),
+    "text-embedding-3-large": (3072, True),
+    "text-embedding-ada-002": (1536, False),
+}
+
+class HashingEmbedder:
+    """
+    基于哈希 n-gram 特征的确定性文本嵌入
+    特征为 NFKC 规范化并转小写的文本（首尾补空格）中的字符 3-gram、词（中日韩文字与 BMP 以外的字符按单字）及相邻词对。
+    片段哈希为码点的多项式哈希（模 2^64），按特征类型与模型名加盐后经 splitmix64 混合，
+    低位取桶号、最高位取符号（带符号的特征哈希，抵消冲突带来的偏差），最后 L2 归一化。
+    numpy 可用时整批输入拼接为一个码点数组，用前缀哈希一次算出全部片段的哈希，再用 bincount 一次累加成矩阵；
+    否则逐条用纯 Python 计算，结果相同
+    """
+    
+    MASK = (1 << 64) - 1
+    PRIME = 0x100000001B3  # 片段哈希的底数（奇数，模 2^64 可逆）
+    PRIME_INVERSE = 0xCE965057AFF6957B  # PRIME 模 2^64 的逆元：PRIME * PRIME_INVERSE ≡ 1
+    PAIR_PRIME = 0x9E3779B97F4A7C15  # 合并相邻词哈希的乘数
+    CHAR_NGRAM = 3
+    KIND_CHAR, KIND_WORD, KIND_PAIR = 1, 2, 3
+    SEPARATOR, WORD, SINGLE = 0, 1, 2  # 字符类别：分隔符 / 词内字符 / 单字成词
+    
+    def __init__(self, backend='auto', max_cells=1 << 22):
+        self.max_cells = max_cells  # 每个子批次的矩阵元素数上限，限制内存占用
+        self._salts = {}
+        self._classes = None
+        self.backend = 'python'
+        self._np = None
+        if backend in ('auto', 'numpy'):
+            try:
+                import numpy
+                self._np = numpy
+                self.backend = 'numpy'
+            except ImportError:
+                if backend == 'numpy':
+                    print("EMBEDDING_BACKEND=numpy 但未安装 numpy，使用纯 Python 计算", file=sys.stderr)
+    
+    @classmethod
+    def classify(cls, ch):
+        """字符类别"""
+        if ord(ch) > 0xFFFF:
+            return cls.SINGLE
+        if ch.isalnum() or ch == '_':
+            return cls.SINGLE if TOKEN_CJK_PATTERN.match(ch) else cls.WORD
+        return cls.SEPARATOR
+    
+    @staticmethod
+    def normalize(text):
+        # \x00 用作批量计算时的文本分界
+        return ' ' + unicodedata.normalize('NFKC', text).lower().replace('\x00', ' ') + ' '
+    
+    def salts(self, model):
+        """各特征类型的盐（不同模型的向量空间互不相同）"""
+        salts = self._salts.get(model)
+        if salts is None:
+            seed = int.from_bytes(hashlib.blake2b(str(model).encode(), digest_size=8).digest(), 'little')
+            salts = tuple((seed + kind * self.PAIR_PRIME) & self.MASK
+                          for kind in (self.KIND_CHAR, self.KIND_WORD, self.KIND_PAIR))
+            if len(self._salts) < 1024:  # 模型名由客户端提供，限制数量
+                self._salts[model] = salts
+        return salts
+    
+    def embed(self, texts, model, dimensions, encoding_format='float'):
+        """
+        计算一批文本的嵌入，返回与 texts 等长的列表
+        encoding_format 为 float 时每项为浮点数列表，为 base64 时每项为小端 float32 的 base64 字符串
+        """
+        if self._np is None:
+            return [self._encode_row(self._embed_python(text, model, dimensions), encoding_format) for text in texts]
+        rows = max(1, self.max_cells // dimensions)
+        result = []
+        for start in range(0, len(texts), rows):
+            matrix = self._embed_numpy(texts[start:start + rows], model, dimensions)
+            if encoding_format == 'base64':
+                matrix = matrix.astype('<f4')
+                result.extend(base64.b64encode(row.tobytes()).decode('ascii') for row in matrix)
+            else:
+                result.extend(self._np.round(matrix, 8).tolist())
+        return result
+    
+    @staticmethod
+    def _encode_row(vector, encoding_format):
+        if encoding_format == 'base64':
+            return base64.b64encode(struct.pack(f'<{len(vector)}f', *vector)).decode('ascii')
+        return [round(value, 8) for value in vector]
+    
+    # ---- 纯 Python 实现 ----
+    
+    @classmethod
+    def _mix(cls, x):
+        """splitmix64 混合函数"""
+        x ^= x >> 30
+        x = (x * 0xBF58476D1CE4E5B9) & cls.MASK
+        x ^= x >> 27
+        x = (x * 0x94D049BB133111EB) & cls.MASK
+        return x ^ (x >> 31)
+    
+    def _span_hash(self, codes):
+        h = 0
+        for code in reversed(codes):
+            h = (h * self.PRIME + code) & self.MASK
+        return h
+    
+    def _embed_python(self, text, model, dimensions):
+        char_salt, word_salt, pair_salt = self.salts(model)
+        text = self.normalize(text)
+        codes = [ord(ch) for ch in text]
+        features = []
+        n = self.CHAR_NGRAM
+        for start in range(len(codes) - n + 1):
+            features.append(self._mix(self._span_hash(codes[start:start + n]) ^ char_salt))
+        
+        words = []
+        start = None
+        for i, ch in enumerate(text):
+            kind = self.classify(ch)
+            if kind != self.WORD and start is not None:
+                words.append(self._span_hash(codes[start:i]))
+                start = None
+            if kind == self.WORD and start is None:
+                start = i
+            elif kind == self.SINGLE:
+                words.append(codes[i])
+        features.extend(self._mix(h ^ word_salt) for h in words)
+        features.extend(self._mix(((a * self.PAIR_PRIME + b) & self.MASK) ^ pair_salt)
+                        for a, b in zip(words, words[1:]))
+        
+        vector = [0.0] * dimensions
+        for feature in features:
+            vector[feature % dimensions] += -1.0 if feature >> 63 else 1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+    
+    # ---- numpy 实现 ----
+    
+    def _class_table(self):
+        """BMP 字符的类别表（首次使用时生成）"""
+        if self._classes is None:
+            np = self._np
+            self._classes = np.fromiter((self.classify(chr(cp)) for cp in range(0x10000)),
+                                        dtype=np.uint8, count=0x10000)
+        return self._classes
+    
+    def _mix_array(self, x):
+        np = self._np
+        x = x ^ (x >> np.uint64(30))
+        x = x * np.uint64(0xBF58476D1CE4E5B9)
+        x = x ^ (x >> np.uint64(27))
+        x = x * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+    
+    def _embed_numpy(self, texts, model, dimensions):
+        np = self._np
+        char_salt, word_salt, pair_salt = (np.uint64(salt) for salt in self.salts(model))
+        joined = ''.join('\x00' + self.normalize(text) for text in texts)
+        codes = np.frombuffer(joined.encode('utf-32-le'), dtype=np.uint32)
+        size = len(codes)
+        # 每个位置所属的文本序号：位置之前（含）的分界符个数 - 1
+        separators = np.concatenate(([0], np.cumsum(codes == 0)))
+        
+        with np.errstate(over='ignore'):
+            # 前缀哈希：prefix[i] = Σ_{j<i} c_j·P^j，片段 [a, b) 的哈希为 (prefix[b] - prefix[a])·P^-a，与位置无关
+            powers = np.empty(size, dtype=np.uint64)
+            powers[0] = 1
+            powers[1:] = np.uint64(self.PRIME)
+            powers = np.cumprod(powers, dtype=np.uint64)
+            inverses = np.empty(size, dtype=np.uint64)
+            inverses[0] = 1
+            inverses[1:] = np.uint64(self.PRIME_INVERSE)
+            inverses = np.cumprod(inverses, dtype=np.uint64)
+            prefix = np.concatenate(([np.uint64(0)], np.cumsum(codes.astype(np.uint64) * powers, dtype=np.uint64)))
+            
+            def span_hash(starts, ends):
+                return (prefix[ends] - prefix[starts]) * inverses[starts]
+            
+            # 字符 n-gram：不跨越文本分界
+            n = self.CHAR_NGRAM
+            starts = np.arange(max(size - n + 1, 0))
+            starts = starts[separators[starts + n] == separators[starts]]
+            char_features = self._mix_array(span_hash(starts, starts + n) ^ char_salt)
+            char_rows = separators[starts + 1] - 1
+            
+            # 词：连续的词内字符为一个词，单字类字符各自成词
+            classes = np.where(codes > 0xFFFF, self.SINGLE, self._class_table()[np.minimum(codes, 0xFFFF)])
+            is_word = classes == self.WORD
+            edges = np.diff(np.concatenate(([False], is_word, [False])).astype(np.int8))
+            singles = np.flatnonzero(classes == self.SINGLE)
+            word_starts = np.concatenate((np.flatnonzero(edges == 1), singles))
+            word_ends = np.concatenate((np.flatnonzero(edges == -1), singles + 1))
+            order = np.argsort(word_starts, kind='stable')
+            word_starts, word_ends = word_starts[order], word_ends[order]
+            words = span_hash(word_starts, word_ends)
+            word_features = self._mix_array(words ^ word_salt)
+            word_rows = separators[word_starts + 1] - 1
+            
+            # 相邻词对（同一文本内）
+            same = word_rows[1:] == word_rows[:-1]
+            pair_features = self._mix_array((words[:-1][same] * np.uint64(self.PAIR_PRIME) + words[1:][same]) ^ pair_salt)
+            pair_rows = word_rows[1:][same]
+        
+        features = np.concatenate((char_features, word_features, pair_features))
+        rows = np.concatenate((char_rows, word_rows, pair_rows)).astype(np.int64)
+        buckets = (features % np.uint64(dimensions)).astype(np.int64)
+        signs = np.where(features >> np.uint64(63), -1.0, 1.0)
+        matrix = np.bincount(rows * dimensions + buckets, weights=signs,
+                             minlength=len(texts) * dimensions).reshape(len(texts), dimensions)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+embedder = HashingEmbedder(EMBEDDING_BACKEND)
+
+# messages 数组某个前缀的解析结果：history 为 user/assistant 配对列表（只读共享），tokens 为累计 token 数，
+# facts 为从这些消息中提取的事实索引
+PrefixState = namedtuple('PrefixState', ['history', 'tokens', 'facts'])
+EMPTY_PREFIX = PrefixState([], 0, EMPTY_FACTS)
+
+class ConversationPrefixCache:
+    """
+    messages 数组前缀缓存
+    OpenAI 风格的客户端每轮都会重发不断增长的完整对话。这里逐条计算消息前缀的滚动哈希，
+    从最长的已缓存前缀继续，只解析、计数新追加的消息，避免每轮重新遍历整个对话。
+    token 数与分词器相关，因此摘要以分词器名为种子，不同分词器的前缀分别缓存。
+    缓存中的 history 列表与配对字典在多个请求间共享，调用方不得修改。
+    """
+    
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # 前缀摘要 -> PrefixState
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _digests(messages, profile):
+        digests = []
+        digest = profile.name.encode()
+        for msg in messages:
+            content = msg.get('content', '')
+            if not isinstance(content, str):
+                content = json_codec.dumps(content, sort_keys=True)
+            digest = hashlib.blake2b(
+                digest + f"{msg.get('role', '')}\0{content}".encode('utf-8', 'surrogatepass'),
+                digest_size=16
+            ).digest()
+            digests.append(digest)
+        return digests
+    
+    @staticmethod
+    def _extend(state, messages, profile):
+        """在 state 基础上解析追加的消息（写时复制，不修改 state）"""
+        history = state.history
+        tokens = state.tokens
+        facts = state.facts
+        copied = False
+        for msg in messages:
+            content = msg.get('content', '')
+            tokens += token_counter.count_message(msg, profile)
+            role = msg.get('role')
+            if role == 'user':
+                if not copied:
+                    history, copied = list(history), True
+                history.append({'user': content, 'assistant': ''})
+                facts = extract_user_facts(facts, content)
+            elif role == 'assistant' and history:
+                if not copied:
+                    history, copied = list(history), True
+                history[-1] = {'user': history[-1]['user'], 'assistant': content}
+                facts = extract_reply_facts(facts, content)
+        return PrefixState(history, tokens, facts)
+    
+    def _get(self, digest):
+        with self._lock:
+            state = self._entries.get(digest)
+            if state is not None:
+                self._entries.move_to_end(digest)
+            return state
+    
+    def _put(self, digest, state):
+        with self._lock:
+            self._entries[digest] = state
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def resolve(self, messages, model=None):
+        """
+        返回 (context, total)：context 为除最后一条消息外的前缀状态（对话历史），
+        total 为完整 messages 的前缀状态（用于统计 prompt token 数），token 按 model 的分词器计算
+        """
+        if not messages:
+            return EMPTY_PREFIX, EMPTY_PREFIX
+        profile = token_counter.profile(model)
+        digests = self._digests(messages, profile)
+        start, state = 0, EMPTY_PREFIX
+        for length in range(len(messages), 0, -1):
+            cached = self._get(digests[length - 1])
+            if cached is not None:
+                start, state = length, cached
+                break
+        
+        n = len(messages)
+        if start < n - 1:
+            state = self._extend(state, messages[start:n - 1], profile)
+            self._put(digests[n - 2], state)
+        if start < n:
+            context = state
+            total = self._extend(state, messages[n - 1:], profile)
+            self._put(digests[n - 1], total)
+        else:
+            context = self._get(digests[n - 2]) if n > 1 else EMPTY_PREFIX
+            if context is None:
+                context = self._extend(EMPTY_PREFIX, messages[:n - 1], profile)
+            total = state
+        return context, total
+
+conversation_cache = ConversationPrefixCache()
+
 def generate_intelligent_response(user_message, model, conversation_history=None, messages_context=None):
     """
     生成智能响应，支持两种上下文方式：
     1. conversation_history: 从服务器缓存中获取的历史
     2. messages_context: 从请求的 messages 数组中获取的完整对话历史
     """
+    return generate_response(user_message, model, conversation_history, messages_context)[1]
+
+def generate_response(user_message, model, conversation_history=None, messages_context=None,
+                      context=None, facts=None):
+    """
+    与 generate_intelligent_response 相同，但返回 (intent, content)，intent 为命中的响应分支
+    context 为 conversation_cache.resolve(messages_context) 已解析出的前缀状态，可省去重复解析；
+    facts 为会话的事实索引（session_store.touch 的返回值），未传入时从 conversation_history 重建
+    """
     msg_lower = user_message.lower()
+    # 一次扫描得到所有命中的关键词，下面各分支按原有优先级判断
+    hits = intent_matcher.match(msg_lower)
+    
+    reply = None
+    if hits & CONTEXT_WORDS:
+        # 合并两种上下文来源：先是 messages 数组中的历史（OpenAI 标准方式），再是缓存的历史
+        if context is None:
+            context = conversation_cache.resolve(messages_context, model)[0] if messages_context else EMPTY_PREFIX
+        if facts is None:
+            facts = facts_from_history(conversation_history or ())
+        # 缓存的会话历史在 messages 数组的历史之后，其中的事实更新
+        reply = respond_from_facts(user_message, hits, merge_facts(context.facts, facts))
+    
+    if reply is None:
+        reply = cached_stateless_response(user_message, model, hits)
+    metric_intents.inc(reply[0])
+    return reply
+
+def cached_stateless_response(user_message, model, hits):
+    """其余分支只取决于模型和当前消息，可以缓存（时间类回复除外）"""
+    if response_cache is None:
+        return respond_stateless(user_message, model, hits)
+    key = response_cache_key(model, user_message)
+    reply = response_cache.get(key)
+    if reply is None:
+        reply = respond_stateless(user_message, model, hits)
+        if reply[0] not in UNCACHEABLE_INTENTS:
+            response_cache.put(key, reply)
+    return reply
+
+def evaluate_followup(previous, expression):
+    """计算基于上一轮结果的表达式"""
+    try:
+        result = math_engine.evaluate(expression)
+    except MathError as e:
+        return f"基于之前的结果 {previous}，{expression} 无法计算：{e}"
+    return f"基于之前的结果 {previous}，{expression} = {result}"
+
+def respond_from_facts(user_message, hits, facts):
+    """处理引用对话历史的后续问题（查询事实索引），返回 (intent, content)，不适用时返回 None"""
+    # 检查是否询问之前记住的内容
+    if "记住" in hits and ("什么" in hits or "?" in user_message) and facts.memory is not None:
+        if facts.memory_quoted:
+            return "memory_recall", f"您之前说过：{facts.memory}"
+        return "memory_recall", f"您之前让我记住的是：{facts.memory}"
     
-    # 合并两种上下文来源
-    combined_history = []
-    
-    # 先处理 messages 数组中的历史（OpenAI 标准方式）
-    if messages_context and len(messages_context) > 1:
-        for msg in messages_context[:-1]:  # 排除最后一条（当前消息）
-            if msg.get('role') == 'user':
-                combined_history.append({
-                    'user': msg.get('content', ''),
-                    'assistant': ''
-                })
-            elif msg.get('role') == 'assistant' and combined_history:
-                combined_history[-1]['assistant'] = msg.get('content', '')
-    
-    # 再添加缓存的历史
-    if conversation_history:
-        combined_history.extend(conversation_history)
-    
-    # 如果有对话历史，先检查是否是后续问题
-    if combined_history and len(combined_history) > 0:
-        # 检查是否是指代性问题或询问之前的内容
-        if any(word in msg_lower for word in ["这个", "那个", "刚才", "上面", "之前", "记住", "什么", "it", "that", "this", "what"]):
-            last_exchange = combined_history[-1] if combined_history else None
-            if last_exchange:
-                # 基于之前的对话生成响应
-                prev_user = last_exchange.get('user', '')
-                prev_response = last_exchange.get('assistant', '')
-                
-                # 检查是否询问之前记住的内容
-                if "记住" in msg_lower and ("什么" in msg_lower or "?" in user_message):
-                    # 查找之前用户提到的"记住"相关内容
-                    for hist in reversed(combined_history):
-                        user_msg = hist.get('user', '').lower()
-                        if "记住" in user_msg or "记得" in user_msg:
-                            # 提取要记住的内容
-                            import re
-                            # 尝试提取冒号后的内容
-                            if "：" in hist.get('user', ''):
-                                remember_content = hist.get('user', '').split('：')[1].strip()
-                                return f"您之前让我记住的是：{remember_content}"
-                            elif ":" in hist.get('user', ''):
-                                remember_content = hist.get('user', '').split(':')[1].strip()
-                                return f"您之前让我记住的是：{remember_content}"
-                            else:
-                                return f"您之前说过：{hist.get('user', '')}"
-                
-                # 检查是否询问名字
-                if ("叫什么" in msg_lower or "名字" in msg_lower) and "?" in user_message:
-                    for hist in reversed(combined_history):
-                        user_msg = hist.get('user', '')
-                        if "我叫" in user_msg or "我是" in user_msg or "名字" in user_msg:
-                            # 尝试提取名字
-                            import re
-                            name_match = re.search(r'我叫(\S+)', user_msg)
-                            if name_match:
-                                return f"您之前告诉我您叫{name_match.group(1)}"
-                            # 查找包含名字的模式
-                            if "：" in user_msg and "名字" in user_msg:
-                                name_part = user_msg.split('：')[1].split('，')[0].strip()
-                                return f"您之前告诉我您叫{name_part}"
-                
-                # 检查是否在引用之前的数学计算
-                if any(word in msg_lower for word in ["结果", "答案", "这个数", "那个数", "乘", "加", "减", "除"]):
-                    # 尝试从之前的响应中提取数字
-                    import re
-                    numbers = re.findall(r'\d+', prev_response)
-                    if numbers and any(word in msg_lower for word in ["乘", "加", "减", "除", "*", "+", "-", "/"]):
-                        # 构建新的数学表达式
-                        if "乘" in user_message or "*" in user_message:
-                            factor = re.findall(r'\d+', user_message)
-                            if factor and numbers:
-                                new_calc = f"{numbers[-1]} * {factor[0]}"
-                                result = eval(new_calc, {"__builtins__": {}})
-                                return f"基于之前的结果 {numbers[-1]}，{new_calc} = {result}"
-                        elif "加" in user_message or "+" in user_message:
-                            addend = re.findall(r'\d+', user_message)
-                            if addend and numbers:
-                                new_calc = f"{numbers[-1]} + {addend[0]}"
-                                result = eval(new_calc, {"__builtins__": {}})
-                                return f"基于之前的结果 {numbers[-1]}，{new_calc} = {result}"
-                        elif "减" in user_message or "-" in user_message:
-                            subtrahend = re.findall(r'\d+', user_message)
-                            if subtrahend and numbers:
-                                new_calc = f"{numbers[-1]} - {subtrahend[0]}"
-                                result = eval(new_calc, {"__builtins__": {}})
-                                return f"基于之前的结果 {numbers[-1]}，{new_calc} = {result}"
-                        elif "除" in user_message or "/" in user_message:
-                            divisor = re.findall(r'\d+', user_message)
-                            if divisor and numbers and int(divisor[0]) != 0:
-                                new_calc = f"{numbers[-1]} / {divisor[0]}"
-                                result = eval(new_calc, {"__builtins__": {}})
-                                return f"基于之前的结果 {numbers[-1]}，{new_calc} = {result}"
+    # 检查是否询问名字
+    if ("叫什么" in hits or "名字" in hits) and "?" in user_message and facts.name is not None:
+        return "name_recall", f"您之前告诉我您叫{facts.name}"
     
+    # 检查是否在引用之前的数学计算（基于最近一次回复中的数字）
+    previous = facts.number
+    if hits & MATH_REFERENCE_WORDS and previous is not None and hits & MATH_OPERATOR_WORDS:
+        operand = NUMBER_PATTERN.findall(user_message)
+        # 构建新的数学表达式
+        if "乘" in hits or "*" in hits:
+            if operand:
+                return "math_followup", evaluate_followup(previous, f"{previous} * {operand[0]}")
+        elif "加" in hits or "+" in hits:
+            if operand:
+                return "math_followup", evaluate_followup(previous, f"{previous} + {operand[0]}")
+        elif "减" in hits or "-" in hits:
+            if operand:
+                return "math_followup", evaluate_followup(previous, f"{previous} - {operand[0]}")
+        elif "除" in hits or "/" in hits:
+            if operand and int(operand[0]) != 0:
+                return "math_followup", evaluate_followup(previous, f"{previous} / {operand[0]}")
+    
+    return None
+
+def respond_stateless(user_message, model, hits):
+    """处理不依赖对话历史的分支，返回 (intent, content)"""
     # 1. 先尝试数学计算
-    math_result = process_math(user_message)
+    try:
+        math_result = process_math(user_message)
+    except MathTimeout as e:
+        return "math_timeout", f"{strip_math_words(user_message)}：无法计算，{e}"
+    except MathError as e:
+        return "math", f"{strip_math_words(user_message)}：无法计算，{e}"
     if math_result:
         # 对于数学问题，返回简洁的答案
         # 提取原始的数学表达式部分
-        math_expr = user_message.replace('?', '').replace('=', '').replace('？', '')
-        math_expr = math_expr.replace('等于多少', '').replace('等于', '').replace('是多少', '')
-        math_expr = math_expr.replace('equals', '').replace('what is', '').replace('calculate', '')
-        math_expr = math_expr.strip()
-        return f"{math_expr} = {math_result}"
+        math_expr = strip_math_words(user_message)
+        return "math", f"{math_expr} = {math_result}"
     
     # 2. 问候语响应
-    greetings = {
-        "hello": "Hello! How can I assist you today?",
-        "hi": "Hi there! What can I help you with?",
-        "你好": "你好！有什么我可以帮助您的吗？",
-        "您好": "您好！请问需要什么帮助？",
-    }
-    for key, response in greetings.items():
-        if key in msg_lower:
-            return response
+    for key, response in GREETINGS.items():
+        if key in hits:
+            return "greeting", response
     
     # 3. 自我介绍
-    if any(word in msg_lower for word in ["你是谁", "who are you", "介绍一下你", "introduce yourself"]):
-        return """我是一个 AI 助手，基于先进的语言模型技术。我可以：
+    if hits & IDENTITY_WORDS:
+        return "identity", """我是一个 AI 助手，基于先进的语言模型技术。我可以：
 • 回答各种问题
 • 帮助编写和调试代码  
 • 进行文本翻译
@@ -227,9 +1829,9 @@ def generate_intelligent_response(user_message, model, conversation_history=None
 有什么需要帮助的，请随时告诉我！"""
     
     # 4. 编程相关
-    if any(word in msg_lower for word in ["python", "javascript", "java", "code", "代码", "编程"]):
-        if "python" in msg_lower:
-            return """Python 示例代码：
+    if hits & PROGRAMMING_WORDS:
+        if "python" in hits:
+            return "programming", """Python 示例代码：
 ```python
 def hello_world():
     print("Hello, World!")
@@ -238,8 +1840,8 @@ def hello_world():
 hello_world()
 ```
 需要更多 Python 帮助吗？"""
-        elif "javascript" in msg_lower:
-            return """JavaScript 示例代码：
+        elif "javascript" in hits:
+            return "programming", """JavaScript 示例代码：
 ```javascript
 function helloWorld() {
     console.log("Hello, World!");
@@ -250,32 +1852,33 @@ helloWorld();
 ```
 需要更多 JavaScript 帮助吗？"""
         else:
-            return "我可以帮助您编写各种编程语言的代码。请告诉我您需要什么语言和功能。"
+            return "programming", "我可以帮助您编写各种编程语言的代码。请告诉我您需要什么语言和功能。"
     
     # 5. 时间相关
-    if any(word in msg_lower for word in ["时间", "time", "几点", "日期", "date"]):
-        return f"当前时间：{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}"
+    if hits & TIME_WORDS:
+        return "time", f"当前时间：{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}"
     
     # 6. 天气（说明无法获取）
-    if any(word in msg_lower for word in ["天气", "weather", "温度", "temperature"]):
-        return "抱歉，我无法获取实时天气信息。建议您查看天气预报应用或网站。"
+    if hits & WEATHER_WORDS:
+        return "weather", "抱歉，我无法获取实时天气信息。建议您查看天气预报应用或网站。"
     
     # 7. 翻译请求
-    if any(word in msg_lower for word in ["翻译", "translate", "translation"]):
-        return "请提供需要翻译的文本和目标语言。例如：'翻译 Hello 到中文'"
+    if hits & TRANSLATE_WORDS:
+        return "translate", "请提供需要翻译的文本和目标语言。例如：'翻译 Hello 到中文'"
     
     # 8. 问题类型判断
-    if "?" in user_message or any(word in user_message for word in ["什么", "如何", "为什么", "怎么", "what", "how", "why"]):
+    # 问题词按原始大小写匹配，只需复查在小写文本中已命中的词
+    if "?" in user_message or any(word in user_message for word in hits & QUESTION_WORDS):
         # 根据模型返回相应的回答风格
         if "claude" in model:
-            return f"这是一个很好的问题。关于 '{user_message}'，让我为您详细解答..."
+            return "question", f"这是一个很好的问题。关于 '{user_message}'，让我为您详细解答..."
         elif "gpt" in model:
-            return f"针对您的问题 '{user_message}'，我的回答是..."
+            return "question", f"针对您的问题 '{user_message}'，我的回答是..."
         else:
-            return f"关于 '{user_message}'，根据我的理解..."
+            return "question", f"关于 '{user_message}'，根据我的理解..."
     
     # 9. 默认智能响应
-    return f"我理解您的需求：'{user_message}'。请提供更多细节，以便我能够更准确地帮助您。"
+    return "default", f"我理解您的需求：'{user_message}'。请提供更多细节，以便我能够更准确地帮助您。"
 
 def get_html_content():
     """获取HTML内容"""
@@ -378,7 +1981,7 @@ def get_html_content():
             <div class="info">
                 <p><strong>状态:</strong> <span class="status">运行中</span></p>
                 <p><strong>版本:</strong> Production v3.1 - 支持{len(MODELS)}个最新AI模型（包括Claude 4.5 Sonnet）</p>
-                <p><strong>API密钥:</strong> <code>{'已配置 (环境变量)' if API_KEY != 'sk-default-key-please-change' else '未配置 - 请设置环境变量'}</code></p>
+                <p><strong>API密钥:</strong> <code>{'已配置 (环境变量)' if API_KEY != 'sk-default-key-please-change' or API_KEYS or API_KEYS_FILE else '未配置 - 请设置环境变量'}</code></p>
                 <p><strong>基础URL:</strong> <code>https://api.autoschool.eu.org</code></p>
             </div>
             
@@ -425,190 +2028,1478 @@ def get_html_content():
     </html>
     """
 
+class Response:
+    """与传输层无关的 HTTP 响应
+
+    body 为 bytes；流式响应时为逐块产生 bytes 的迭代器。
+    传输层写完响应后必须调用 close()，以触发通过 on_close() 注册的回调。
+    """
+    
+    def __init__(self, status, headers=None, body=b''):
+        self.status = status
+        self.headers = list(headers or [])
+        self.body = body
+        self._callbacks = []
+    
+    @property
+    def streaming(self):
+        return not isinstance(self.body, (bytes, bytearray))
+    
+    def on_close(self, callback):
+        self._callbacks.append(callback)
+    
+    def close(self):
+        if self.streaming and hasattr(self.body, 'close'):
+            self.body.close()
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+class RequestBody:
+    """限定长度的请求体读取器，避免越界读到同一连接上的下一个请求"""
+    
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = max(length, 0)
+    
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return b''
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+    
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return b''
+        line = self.stream.readline(size)
+        self.remaining -= len(line)
+        return line
+    
+    def __iter__(self):
+        return iter(self.readline, b'')
+    
+    def drain(self):
+        """丢弃未读取的剩余请求体"""
+        while self.remaining > 0 and self.read(65536):
+            pass
+
+# 一个 API 密钥：digest 为 sha256 摘要（内存中不保存明文），rpm / tpm 为每分钟请求数 / token 数上限（0 表示不限）
+ApiKey = namedtuple('ApiKey', ['name', 'digest', 'rpm', 'tpm'])
+
+class KeyRegistry:
+    """
+    API 密钥索引
+    按 sha256 摘要建立字典，查找为 O(1)；命中后再用 hmac.compare_digest 比较摘要，比较耗时与密钥内容无关
+    """
+    
+    def __init__(self):
+        self._keys = {}
+    
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode('utf-8', 'surrogatepass')).digest()
+    
+    def add(self, token, rpm=0, tpm=0, name=None):
+        digest = self.digest(token)
+        self._keys[digest] = ApiKey(name or f"key-{digest[:4].hex()}", digest, rpm, tpm)
+    
+    def lookup(self, token):
+        """返回 token 对应的 ApiKey，不存在时返回 None"""
+        digest = self.digest(token)
+        key = self._keys.get(digest)
+        if key is not None and hmac.compare_digest(key.digest, digest):
+            return key
+        return None
+    
+    def __len__(self):
+        return len(self._keys)
+
+def parse_key_spec(spec, separator):
+    """解析 key[:rpm[:tpm]] / "key rpm tpm"，未指定的限额使用默认值"""
+    parts = spec.split(separator) if separator else spec.split()
+    token = parts[0].strip()
+    rpm = int(parts[1]) if len(parts) > 1 and parts[1].strip() else RATE_LIMIT
+    tpm = int(parts[2]) if len(parts) > 2 and parts[2].strip() else TOKEN_RATE_LIMIT
+    return token, rpm, tpm
+
+def load_key_registry():
+    """从 API_KEYS、API_KEYS_FILE 与 API_KEY 加载密钥"""
+    registry = KeyRegistry()
+    for spec in API_KEYS.split(','):
+        if spec.strip():
+            registry.add(*parse_key_spec(spec.strip(), ':'))
+    if API_KEYS_FILE:
+        with open(API_KEYS_FILE, encoding='utf-8') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    registry.add(*parse_key_spec(line, None))
+    # 配置了多密钥时，未显式设置的默认 API_KEY 不再生效
+    if 'API_KEY' in os.environ or not len(registry):
+        registry.add(API_KEY, RATE_LIMIT, TOKEN_RATE_LIMIT, name='default')
+    return registry
+
+key_registry = load_key_registry()
+
+def authenticate(headers):
+    """根据 Authorization 头返回 ApiKey，未认证时返回 None"""
+    auth = headers.get('Authorization', '')
+    if not auth.startswith('Bearer '):
+        return None
+    return key_registry.lookup(auth[len('Bearer '):])
+
+def check_auth(headers):
+    """校验 Authorization 头"""
+    return authenticate(headers) is not None
+
+class RateLimiter:
+    """
+    按密钥的令牌桶限流：每个密钥一个请求桶（rpm）和一个 token 桶（tpm），容量为每分钟限额，匀速补充
+    桶按密钥摘要分散到多个带锁的分片中，不同密钥的请求很少争用同一把锁
+    """
+    
+    def __init__(self, stripes=16):
+        self._stripes = [(threading.Lock(), {}) for _ in range(stripes)]
+    
+    def _stripe(self, key):
+        return self._stripes[key.digest[0] % len(self._stripes)]
+    
+    @staticmethod
+    def _refill(bucket, limit, now):
+        # bucket = [可用额度, 上次补充时间]
+        bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * limit / 60)
+        bucket[1] = now
+    
+    def acquire(self, key, tokens=0, now=None):
+        """
+        占用 1 个请求和 tokens 个 token 的额度
+        额度足够时扣除并返回 0，否则不扣除并返回需要等待的秒数
+        """
+        if not key.rpm and not key.tpm:
+            return 0
+        now = time.monotonic() if now is None else now
+        lock, buckets = self._stripe(key)
+        with lock:
+            pair = buckets.get(key.digest)
+            if pair is None:
+                pair = buckets[key.digest] = ([key.rpm, now], [key.tpm, now])
+            requests, token_bucket = pair
+            wait = 0
+            if key.rpm:
+                self._refill(requests, key.rpm, now)
+                if requests[0] < 1:
+                    wait = (1 - requests[0]) * 60 / key.rpm
+            if key.tpm:
+                self._refill(token_bucket, key.tpm, now)
+                # 单次请求超过整个桶容量时，等桶满即可放行，避免永远无法通过
+                need = min(tokens, key.tpm)
+                if token_bucket[0] < need:
+                    wait = max(wait, (need - token_bucket[0]) * 60 / key.tpm)
+            if wait:
+                return wait
+            if key.rpm:
+                requests[0] -= 1
+            if key.tpm:
+                token_bucket[0] -= tokens
+            return 0
+    
+    def charge(self, key, tokens, now=None):
+        """事后扣除 token 额度（如生成的回复），额度可以变为负数，由后续请求等待补足"""
+        if not key.tpm or not tokens:
+            return
+        now = time.monotonic() if now is None else now
+        lock, buckets = self._stripe(key)
+        with lock:
+            pair = buckets.get(key.digest)
+            if pair is None:
+                pair = buckets[key.digest] = ([key.rpm, now], [key.tpm, now])
+            self._refill(pair[1], key.tpm, now)
+            pair[1][0] -= tokens
+
+rate_limiter = RateLimiter()
+
+class AdmissionRejected(Exception):
+    """准入控制拒绝了请求，retry_after 为建议的重试等待秒数"""
+    
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    全局准入控制与过载保护
+    同时处理的请求数不超过 limit，超出的请求按先后顺序进入有界等待队列。
+    队列已满，或按队列深度与平均处理耗时估算的等待时间超过 queue_timeout 时立即拒绝（503），
+    不必先排满整个时限；已排队的请求超过 queue_timeout 仍未获得许可时同样拒绝。
+    limit 按 AIMD 自适应：处理延迟超过 target_latency 时乘性减小，延迟正常且并发已用满时加性增大。
+    传输层须在把请求交给线程池之前申请许可（见 try_acquire），并用 clamp() 把上限限制在线程数以内，
+    否则超出的请求在线程池队列或内核 backlog 中等待，准入控制看不到它们。
+    """
+    
+    def __init__(self, max_limit, min_limit=4, queue_size=128, queue_timeout=2.0,
+                 target_latency=1.0, backoff=0.9, smoothing=0.2):
+        self.max_limit = max_limit
+        self.min_limit = max(1, min(min_limit, max_limit))
+        self.limit = float(max_limit)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.smoothing = smoothing
+        # 处理耗时的指数滑动平均，用于估算排队等待时间；还没有样本时按 target_latency 估算
+        self.latency = target_latency
+        self.in_flight = 0
+        self.rejected = 0
+        self._last_decrease = 0.0
+        self._waiters = deque()  # 排队中的请求：获得许可时调用的 notify()，按到达顺序
+        self._lock = threading.Lock()
+    
+    @property
+    def waiting(self):
+        return len(self._waiters)
+    
+    def clamp(self, max_limit):
+        """把并发上限限制在 max_limit（服务器的处理线程数）以内"""
+        with self._lock:
+            self.max_limit = max(1, min(self.max_limit, max_limit))
+            self.min_limit = min(self.min_limit, self.max_limit)
+            self.limit = min(self.limit, float(self.max_limit))
+    
+    def try_acquire(self, notify):
+        """
+        不阻塞地申请许可：立即获得时返回 True；否则登记 notify 并返回 False，
+        之后许可空出时（在归还许可的线程中）调用 notify() 通知，调用方此时即持有许可。
+        队列已满或预计等待超过 queue_timeout 时抛出 AdmissionRejected
+        """
+        with self._lock:
+            if self.in_flight < int(self.limit) and not self._waiters:
+                self.in_flight += 1
+                return True
+            if len(self._waiters) >= self.queue_size:
+                self.rejected += 1
+                raise AdmissionRejected('Server overloaded, request queue is full', self.queue_timeout)
+            # 前面每 limit 个请求大约需要一个平均处理耗时才能让出许可
+            wait = (len(self._waiters) + 1) * self.latency / int(self.limit)
+            if wait > self.queue_timeout:
+                self.rejected += 1
+                raise AdmissionRejected('Server overloaded, estimated queue time exceeds budget', wait)
+            self._waiters.append(notify)
+            return False
+    
+    def cancel(self, notify):
+        """撤销排队中的 notify，返回 False 表示许可已在此之前授予（调用方持有许可，需要归还）"""
+        with self._lock:
+            try:
+                self._waiters.remove(notify)
+            except ValueError:
+                return False
+            return True
+    
+    def expire(self, notify):
+        """排队超时：撤销登记并抛出 AdmissionRejected；许可恰好已经授予时直接返回"""
+        if self.cancel(notify):
+            with self._lock:
+                self.rejected += 1
+            raise AdmissionRejected('Server overloaded, queue time budget exceeded', self.queue_timeout)
+    
+    def acquire(self):
+        """在当前线程中阻塞地获取许可，返回许可获得时间；被拒绝时抛出 AdmissionRejected"""
+        granted = threading.Event()
+        if not self.try_acquire(granted.set):
+            if not granted.wait(self.queue_timeout):
+                self.expire(granted.set)
+        return time.monotonic()
+    
+    def release(self, latency=None):
+        """归还许可并按顺序把空出的名额交给排队的请求；latency 为本次请求的处理耗时，用于调整并发上限"""
+        with self._lock:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if latency is not None:
+                self.latency += self.smoothing * (latency - self.latency)
+                now = time.monotonic()
+                if latency > self.target_latency:
+                    # 同一个延迟周期内只减小一次，避免一批慢请求把上限连续压到最低
+                    if now - self._last_decrease > self.target_latency:
+                        self.limit = max(self.min_limit, self.limit * self.backoff)
+                        self._last_decrease = now
+                elif saturated:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            # limit 增大时可能一次空出多个名额
+            granted = []
+            while self._waiters and self.in_flight < int(self.limit):
+                self.in_flight += 1
+                granted.append(self._waiters.popleft())
+        for notify in granted:
+            notify()
+    
+    def admit(self, handle, started=None):
+        """
+        在许可内执行 handle() 并返回其 Response
+        started 为传输层已获得许可的时间，为 None 时在当前线程中阻塞获取。
+        许可在响应关闭时归还；限速的流式响应在第一个 StreamPause 处提前归还，
+        此时内容已生成完毕，剩余时间只是按节奏发送，不应占用并发额度。
+        延迟样本取到 handle() 返回为止，不含客户端读取流的时间
+        """
+        if started is None:
+            started = self.acquire()
+        try:
+            response = handle()
+        except BaseException:
+            self.release()
+            raise
+        latency = time.monotonic() - started
+        once = threading.Lock()
+        
+        def release_once():
+            # 流结束与响应关闭可能发生在不同线程，用非阻塞加锁保证只归还一次
+            if once.acquire(blocking=False):
+                self.release(latency)
+        
+        if response.streaming:
+            response.body = release_on_pause(response.body, release_once)
+        response.on_close(release_once)
+        return response
+
+def release_on_pause(chunks, release):
+    """透传流式响应的 chunk，遇到第一个 StreamPause 时调用 release()"""
+    for chunk in chunks:
+        if isinstance(chunk, StreamPause):
+            release()
+        yield chunk
+
+admission = AdmissionController(
+    MAX_CONCURRENCY, MIN_CONCURRENCY, ADMISSION_QUEUE_SIZE,
+    ADMISSION_QUEUE_TIMEOUT, ADMISSION_TARGET_LATENCY
+) if MAX_CONCURRENCY > 0 else None
+
+# 受准入控制的路由（生成回复的接口）；其余路由开销很小，不占用许可
+ADMITTED_ROUTES = frozenset([('POST', '/v1/chat/completions'), ('POST', '/v1/embeddings')])
+
+def configure_admission(threads):
+    """
+    由服务器在启动时调用：把并发上限限制在处理线程数以内，
+    返回需要为排队中的请求额外预留的连接数（即准入队列长度），未启用准入控制时为 0
+    """
+    if admission is None:
+        return 0
+    admission.clamp(threads)
+    return admission.queue_size
+
+# 状态码 -> (error.type, error.code)，未列出的状态码视为 internal_error
+ERROR_TYPES = {
+    400: ('invalid_request_error', 'invalid_request'),
+    401: ('invalid_request_error', 'invalid_api_key'),
+    429: ('rate_limit_error', 'rate_limit_exceeded'),
+    503: ('server_error', 'server_overloaded'),
+}
+
+def error_body(code, message):
+    """OpenAI 格式的错误对象"""
+    error_type, error_code = ERROR_TYPES.get(code, ('internal_error', 'internal_error'))
+    return {
+        'error': {
+            'message': message,
+            'type': error_type,
+            'code': error_code
+        }
+    }
+
+def error_response(code, message, headers=()):
+    """构造错误响应，headers 为附加的响应头（如 Retry-After）"""
+    metric_errors.inc(str(code))
+    return Response(code, [
+        ('Content-Type', 'application/json'),
+        ('Access-Control-Allow-Origin', '*'),
+        *headers,
+    ], json_codec.encode(error_body(code, message)))
+
+class StaticResponse:
+    """
+    预先生成的静态响应：原始与 gzip 两种编码的 bytes、强 ETag 和缓存头
+    命中 If-None-Match 时返回 304，否则按 Accept-Encoding 选择编码，处理请求时无需再生成内容
+    """
+    
+    def __init__(self, body, content_type, cache_control):
+        self.body = body
+        # 固定 mtime=0，使相同内容的 gzip 字节（及其 ETag）稳定；gzip.compress 的 mtime 参数需要 3.8
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+            f.write(body)
+        self.gzip_body = buffer.getvalue()
+        digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+        # 强 ETag 对应具体的字节内容，两种编码需使用不同的值
+        self.etag = f'"{digest}"'
+        self.gzip_etag = f'"{digest}-gz"'
+        self.headers = [
+            ('Content-Type', content_type),
+            ('Cache-Control', cache_control),
+            ('Vary', 'Accept-Encoding'),
+            ('Access-Control-Allow-Origin', '*'),
+        ]
+    
+    @staticmethod
+    def accepts_gzip(headers):
+        """
+        先解析出每种编码的 q 值再判断：显式的 gzip 项优先于 *，q=0 表示拒绝
+        （逐项提前返回会把 "*;q=0, gzip" 或 "gzip;q=0, *" 判断错）
+        """
+        weights = {}
+        for item in headers.get('Accept-Encoding', '').lower().split(','):
+            coding, *params = item.split(';')
+            q = 1.0
+            for param in params:
+                name, _, value = param.strip().partition('=')
+                if name == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            weights[coding.strip()] = q
+        for coding in ('gzip', 'x-gzip', '*'):
+            if coding in weights:
+                return weights[coding] > 0
+        return False
+    
+    def not_modified(self, headers):
+        if_none_match = headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        # If-None-Match 使用弱比较：忽略 W/ 前缀
+        tags = {tag[2:] if tag.startswith('W/') else tag for tag in map(str.strip, if_none_match.split(','))}
+        return self.etag in tags or self.gzip_etag in tags
+    
+    def respond(self, headers):
+        use_gzip = self.accepts_gzip(headers)
+        etag = self.gzip_etag if use_gzip else self.etag
+        if self.not_modified(headers):
+            return Response(304, self.headers[1:] + [('ETag', etag)])
+        if use_gzip:
+            return Response(200, self.headers + [('ETag', etag), ('Content-Encoding', 'gzip')], self.gzip_body)
+        return Response(200, self.headers + [('ETag', etag)], self.body)
+
+STATIC_RESPONSES = {}
+
+def rebuild_static_responses():
+    """根据当前 MODELS / EMBEDDING_MODELS / API_KEY 重新生成静态响应，修改这些配置后需调用"""
+    created = int(time.time())
+    models_list = [{"id": m, "object": "model", "created": created, "owned_by": "system"}
+                   for m in MODELS + list(EMBEDDING_MODELS)]
+    STATIC_RESPONSES['/'] = StaticResponse(
+        get_html_content().encode(),
+        'text/html; charset=utf-8',
+        f'public, max-age={STATIC_MAX_AGE}, s-maxage={STATIC_S_MAXAGE}'
+    )
+    # 模型列表需要鉴权，不允许共享缓存保存
+    STATIC_RESPONSES['/v1/models'] = StaticResponse(
+        json_codec.encode({"object": "list", "data": models_list}),
+        'application/json',
+        f'private, max-age={STATIC_MAX_AGE}'
+    )
+
+rebuild_static_responses()
+
+def handle_index(headers):
+    """GET / 返回文档页面"""
+    return STATIC_RESPONSES['/'].respond(headers)
+
+def handle_models(headers):
+    """GET /v1/models 返回模型列表"""
+    if not check_auth(headers):
+        return error_response(401, 'Invalid or missing API key')
+    return STATIC_RESPONSES['/v1/models'].respond(headers)
+
+class SSEEncoder:
+    """
+    流式响应的 SSE 编码器
+    同一次补全的所有 chunk 共用一个 id 与 system_fingerprint（与 OpenAI 一致），
+    因此 chunk 中除增量文本外的部分在创建时序列化一次，之后每个 chunk 只需转义增量文本并拼接 bytes。
+    n > 1 时每段增量文本按 index 0..n-1 依次产生 n 个交错的 chunk，文本只转义一次
+    """
+    
+    DONE = b"data: [DONE]\n\n"
+    
+    def __init__(self, model, completion_id=None, fingerprint=None, created=None, n=1):
+        self.completion_id = completion_id or f"chatcmpl-{generate_random_string(16)}"
+        self.fingerprint = fingerprint or f"fp_{generate_random_string(8)}"
+        self.created = int(time.time()) if created is None else created
+        # SSE 的每个事件必须在一行内，因此总是使用紧凑格式
+        head = json_codec.encode({
+            "id": self.completion_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": model,
+            "system_fingerprint": self.fingerprint,
+        }, pretty=False)[:-1]
+        self.prefix = b'data: ' + head + b',"choices":[{"delta":{"content":'
+        self.suffixes = [b'},"index":%d,"logprobs":null,"finish_reason":null}]}\n\n' % i for i in range(n)]
+        self.final = b''.join(
+            b'data: ' + head + b',"choices":[{"delta":{},"index":%d,"logprobs":null,"finish_reason":"stop"}]}\n\n' % i
+            for i in range(n))
+    
+    def chunk(self, text):
+        """编码一段增量文本（n > 1 时为各 choice 的 chunk 依次拼接）"""
+        escaped = encode_json_string(text).encode('utf-8', 'surrogatepass')
+        if len(self.suffixes) == 1:
+            return self.prefix + escaped + self.suffixes[0]
+        return b''.join(self.prefix + escaped + suffix for suffix in self.suffixes)
+
+# 与 json_codec 的字符串转义一致（非 ASCII 字符不转义），使用标准库的 C 实现
+encode_json_string = json.encoder.encode_basestring
+
+def coalesce_chunks(chunks, flush_bytes=STREAM_FLUSH_BYTES):
+    """
+    合并相邻的小 chunk，累计达到 flush_bytes、遇到 StreamPause 或流结束时才产出，减少写入次数
+    flush_bytes 为 0 时逐个 chunk 产出
+    """
+    if flush_bytes <= 0:
+        yield from chunks
+        return
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        if isinstance(chunk, StreamPause):
+            # 暂停前先把已缓冲的数据写出，保证客户端按节奏收到
+            if buffer:
+                yield b''.join(buffer)
+                buffer, size = [], 0
+            yield chunk
+            continue
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= flush_bytes:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+class StreamOptionsError(ValueError):
+    """stream_options 参数无效"""
+
+class ChoiceCountError(ValueError):
+    """n / best_of 参数无效"""
+
+def parse_choice_count(body):
+    """
+    解析请求的 n 与 best_of，返回 (n, best_of)
+    回复由确定性的规则生成，best_of 个候选完全相同，只生成一次，返回其中 n 个；usage 按 best_of 个候选计数
+    """
+    n = body.get('n')
+    n = 1 if n is None else n
+    if isinstance(n, bool) or not isinstance(n, int) or not 1 <= n <= MAX_CHOICES:
+        raise ChoiceCountError(f'n must be an integer between 1 and {MAX_CHOICES}')
+    best_of = body.get('best_of')
+    best_of = n if best_of is None else best_of
+    if isinstance(best_of, bool) or not isinstance(best_of, int) or not n <= best_of <= MAX_CHOICES:
+        raise ChoiceCountError(f'best_of must be an integer between n and {MAX_CHOICES}')
+    return n, best_of
+
+class StreamPause(float):
+    """
+    流式响应中的暂停标记（秒），用于限速输出
+    传输层遇到它时等待相应时间（线程引擎 time.sleep，asyncio 引擎 asyncio.sleep），不写出任何数据
+    """
+
+WORD_PATTERN = re.compile(f'[{CJK_CHARS}]\\s*|[^\\s{CJK_CHARS}]+\\s*|\\s+')
+
+def split_words(text):
+    """按词切分（CJK 按字），各片段拼接后与原文相同"""
+    return WORD_PATTERN.findall(text)
+
+def split_graphemes(text):
+    """
+    按字素簇近似切分：组合附加符、变体选择符、肤色修饰符附着到前一个字符，
+    ZWJ 连接的 emoji 序列与成对的国旗区域指示符合并为一个片段
+    """
+    clusters = []
+    join_next = False
+    for ch in text:
+        code = ord(ch)
+        if clusters and (
+            join_next
+            or unicodedata.combining(ch)
+            or code == 0x200D
+            or 0xFE00 <= code <= 0xFE0F
+            or 0x1F3FB <= code <= 0x1F3FF
+            or 0xE0020 <= code <= 0xE007F
+            or (0x1F1E6 <= code <= 0x1F1FF and len(clusters[-1]) == 1
+                and 0x1F1E6 <= ord(clusters[-1]) <= 0x1F1FF)
+            or unicodedata.category(ch) in ('Mn', 'Me', 'Mc')
+        ):
+            clusters[-1] += ch
+        else:
+            clusters.append(ch)
+        join_next = code == 0x200D
+    return clusters
+
+def split_bytes(text, size):
+    """按不超过 size 个 UTF-8 字节切分，不拆开单个字符"""
+    data = text.encode('utf-8', 'surrogatepass')
+    pieces = []
+    start = 0
+    while start < len(data):
+        end = min(start + size, len(data))
+        # 回退到字符边界（UTF-8 续字节形如 10xxxxxx）
+        while end < len(data) and end > start and data[end] & 0xC0 == 0x80:
+            end -= 1
+        if end == start:
+            # size 小于单个字符的字节数时至少输出一个完整字符
+            end = start + 1
+            while end < len(data) and data[end] & 0xC0 == 0x80:
+                end += 1
+        pieces.append(data[start:end].decode('utf-8', 'surrogatepass'))
+        start = end
+    return pieces
+
+StreamOptions = namedtuple('StreamOptions', ['split', 'window', 'tokens_per_second'])
+
+def parse_granularity(value):
+    """解析粒度配置，返回 (切分函数, 时间窗口秒数)"""
+    name, _, arg = str(value).strip().lower().partition(':')
+    if name == 'word' and not arg:
+        return split_words, 0
+    if name == 'char' and not arg:
+        return list, 0
+    if name == 'grapheme' and not arg:
+        return split_graphemes, 0
+    try:
+        number = int(arg)
+    except ValueError:
+        number = 0
+    if name == 'bytes' and 0 < number <= MAX_STREAM_CHUNK_BYTES:
+        return functools.partial(split_bytes, size=number), 0
+    if name == 'window' and 0 < number <= MAX_STREAM_WINDOW_MS:
+        return split_words, number / 1000
+    raise StreamOptionsError(
+        f"Invalid stream granularity '{value}', expected word, char, grapheme, "
+        f"bytes:N (1-{MAX_STREAM_CHUNK_BYTES}) or window:MS (1-{MAX_STREAM_WINDOW_MS})"
+    )
+
+def parse_stream_options(options):
+    """合并请求中的 stream_options 与服务端默认值"""
+    if options is None:
+        options = {}
+    if not isinstance(options, dict):
+        raise StreamOptionsError('stream_options must be an object')
+    split, window = parse_granularity(options.get('granularity', STREAM_GRANULARITY))
+    rate = options.get('tokens_per_second', STREAM_TOKENS_PER_SECOND)
+    if (isinstance(rate, bool) or not isinstance(rate, (int, float))
+            or not (rate == 0 or STREAM_MIN_TOKENS_PER_SECOND <= rate < float('inf'))):
+        raise StreamOptionsError(
+            f'stream_options.tokens_per_second must be 0 (unlimited) '
+            f'or at least {STREAM_MIN_TOKENS_PER_SECOND:g}'
+        )
+    return StreamOptions(split, window, float(rate))
+
+def iter_chat_stream(model, response_content, options=None, timer=None, n=1):
+    """
+    将响应切分并逐块产生 SSE 数据（n 个 choice 的 chunk 按片段交错发送）
+    设置 tokens_per_second 时按片段计速，在片段之间产生 StreamPause，
+    总时长超过 STREAM_MAX_DURATION 时按比例加快；
+    window 粒度把同一时间窗口内到期的片段合并为一个 chunk 发送；
+    传入 timer 时在 [DONE] 之前以 SSE 注释发送各阶段耗时（客户端会忽略注释行）
+    """
+    options = options or parse_stream_options(None)
+    encoder = SSEEncoder(model, n=n)
+    pieces = options.split(response_content) or ['']
+    rate = options.tokens_per_second
+    
+    if not rate:
+        if options.window:
+            # 不限速时所有片段同时到期，落在同一个窗口内
+            pieces = [response_content]
+        for piece in pieces:
+            yield encoder.chunk(piece)
+    else:
+        interval = min(1 / rate, STREAM_MAX_DURATION / len(pieces))
+        window = max(options.window, interval)
+        started = time.monotonic()
+        pending = []
+        opened = due = 0.0  # 当前窗口的起点与窗口内最后一个片段的计划时间（相对开始时间）
+        for i, piece in enumerate(pieces):
+            at = i * interval
+            if pending and at >= opened + window - interval / 2:
+                # 按累计计划时间等待，避免逐片段 sleep 的误差累积
+                delay = started + due - time.monotonic()
+                if delay > 0:
+                    yield StreamPause(delay)
+                yield encoder.chunk(''.join(pending))
+                pending = []
+            if not pending:
+                opened = at
+            due = at
+            pending.append(piece)
+        delay = started + due - time.monotonic()
+        if delay > 0:
+            yield StreamPause(delay)
+        yield encoder.chunk(''.join(pending))
+    
+    # 发送结束标记
+    yield encoder.final
+    if timer is not None:
+        timer.mark('stream')
+        yield f': server-timing {timer.header()}\n\n'.encode()
+    yield SSEEncoder.DONE
+
+class RateLimited(Exception):
+    """密钥的请求或 token 额度不足，retry_after 为需要等待的秒数"""
+    
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# 一次聊天补全的结果，供单次请求与批量请求共用
+ChatResult = namedtuple('ChatResult', ['model', 'intent', 'content', 'n', 'prompt_tokens', 'completion_tokens'])
+
+def run_chat_completion(body, auth, user_agent, api_key, timer=None, stateless=False):
+    """
+    执行一次聊天补全：计算 prompt、限流、读取会话、生成回复并写回会话，返回 ChatResult
+    n / best_of 无效时抛出 ChoiceCountError，额度不足时抛出 RateLimited。
+    请求解析、上下文合并与回复生成每个请求只做一次，与 n 无关。
+    stateless 为 True 时不读写会话，只依据 messages 生成回复
+    """
+    timer = timer or PhaseTimer()
+    model = body.get('model', 'gpt-3.5-turbo')
+    messages = body.get('messages', [])
+    n, best_of = parse_choice_count(body)
+    
+    # 解析 messages 数组（只处理相对已缓存前缀新增的消息）
+    context, prompt_state = conversation_cache.resolve(messages, model)
+    profile = token_counter.profile(model)
+    prompt_tokens = prompt_state.tokens + profile.reply_overhead
+    timer.mark('prompt')
+    
+    # 按密钥限流：请求数与 prompt token 数先行扣除，回复的 token 数生成后再扣除
+    retry_after = rate_limiter.acquire(api_key, prompt_tokens)
+    if retry_after:
+        raise RateLimited(f'Rate limit exceeded for {api_key.name}, retry after {retry_after:.1f}s', retry_after)
+    timer.mark('ratelimit')
+    
+    if stateless:
+        session_id, facts = None, EMPTY_FACTS
+    else:
+        # 获取会话ID（改进版，支持自定义session_id）
+        session_id = get_session_id(auth, user_agent, body)
+        
+        # 清理过期会话
+        clean_old_sessions()
+        
+        # 更新会话访问时间并获取会话的事实索引
+        facts = session_store.touch(session_id)
+    timer.mark('session')
+    
+    # 获取用户消息
+    user_message = ""
+    for msg in reversed(messages):
+        if msg.get('role') == 'user':
+            user_message = msg.get('content', '')
+            break
+    
+    if not user_message:
+        user_message = "Hello"
+    
+    # 生成智能响应（传入两种上下文：会话的事实索引和 messages 数组）
+    intent, response_content = generate_response(
+        user_message,
+        model,
+        messages_context=messages,  # 传入完整的 messages 数组
+        context=context,
+        facts=facts
+    )
+    timer.mark('generate')
+    
+    # 保存到对话历史
+    if session_id is not None:
+        session_store.append(session_id, {
+            'user': user_message,
+            'assistant': response_content,
+            'timestamp': datetime.now().isoformat()
+        })
+    
+    # 计算token数量（按模型分词器近似计数，消息前缀的计数随 conversation_cache 复用）
+    completion_tokens = token_counter.count(response_content, profile) * best_of
+    rate_limiter.charge(api_key, completion_tokens)
+    timer.mark('persist')
+    return ChatResult(model, intent, response_content, n, prompt_tokens, completion_tokens)
+
+def chat_completion_body(result):
+    """非流式响应的 chat.completion 对象"""
+    return {
+        "id": f"chatcmpl-{generate_random_string(16)}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": result.model,
+        "system_fingerprint": f"fp_{generate_random_string(8)}",
+        "choices": [{
+            "index": index,
+            "message": {
+                "role": "assistant",
+                "content": result.content
+            },
+            "logprobs": None,
+            "finish_reason": "stop"
+        } for index in range(result.n)],
+        "usage": {
+            "prompt_tokens": result.prompt_tokens,
+            "completion_tokens": result.completion_tokens,
+            "total_tokens": result.prompt_tokens + result.completion_tokens
+        }
+    }
+
+def handle_chat_completions(headers, rfile):
+    """POST /v1/chat/completions"""
+    timer = PhaseTimer()
+    auth = headers.get('Authorization', '')
+    api_key = authenticate(headers)
+    if api_key is None:
+        return error_response(401, 'Invalid or missing API key')
+    
+    post_data = rfile.read()
+    timer.mark('read')
+    
+    try:
+        body = json_codec.decode(post_data)
+        timer.mark('parse')
+        stream = body.get('stream', False)
+        if stream:
+            try:
+                stream_options = parse_stream_options(body.get('stream_options'))
+            except StreamOptionsError as e:
+                return error_response(400, str(e))
+        
+        try:
+            result = run_chat_completion(body, auth, headers.get('User-Agent', ''), api_key, timer)
+        except ChoiceCountError as e:
+            return error_response(400, str(e))
+        except RateLimited as e:
+            return error_response(429, str(e), [('Retry-After', str(math.ceil(e.retry_after)))])
+        
+        if stream:
+            # 流式响应（各阶段耗时以 SSE 注释在 [DONE] 之前发送）
+            return track_model(Response(200, [
+                ('Content-Type', 'text/event-stream'),
+                ('Cache-Control', 'no-cache'),
+                ('Access-Control-Allow-Origin', '*'),
+            ], coalesce_chunks(measure_stream(iter_chat_stream(result.model, result.content, stream_options, timer, result.n)))),
+                result.model, timer, result.intent)
+        
+        # 非流式响应
+        payload = json_codec.encode(chat_completion_body(result))
+        timer.mark('serialize')
+        return track_model(Response(200, [
+            ('Content-Type', 'application/json'),
+            ('Access-Control-Allow-Origin', '*'),
+            ('Server-Timing', timer.header()),
+        ], payload), result.model, timer, result.intent)
+        
+    except Exception as e:
+        return error_response(500, str(e))
+
+# 批量接口支持的请求 URL
+BATCH_ENDPOINTS = frozenset(['/v1/chat/completions'])
+
+def parse_batch_line(line):
+    """
+    解析批量请求的一行 {"custom_id", "method", "url", "body"}
+    返回 (custom_id, body, error)，格式不符时 body 为 None、error 为错误说明
+    """
+    try:
+        record = json_codec.decode(line)
+    except ValueError as e:
+        return None, None, f'Invalid JSON: {e}'
+    if not isinstance(record, dict):
+        return None, None, 'Each line must be a JSON object'
+    custom_id = record.get('custom_id')
+    if not isinstance(custom_id, str) or not custom_id:
+        return None, None, 'custom_id must be a non-empty string'
+    if str(record.get('method', 'POST')).upper() != 'POST':
+        return custom_id, None, 'method must be POST'
+    url = record.get('url', '/v1/chat/completions')
+    if url not in BATCH_ENDPOINTS:
+        return custom_id, None, f'Unsupported url: {url}'
+    body = record.get('body')
+    if not isinstance(body, dict):
+        return custom_id, None, 'body must be a JSON object'
+    return custom_id, body, None
+
+def run_batch_line(custom_id, body, error, auth, user_agent, api_key):
+    """执行批量请求中的一行，返回 OpenAI Batch 输出格式的结果对象"""
+    record = {
+        'id': f'batch_req_{generate_random_string(16)}',
+        'custom_id': custom_id,
+        'response': None,
+        'error': None,
+    }
+    if error:
+        record['error'] = {'code': 'invalid_request', 'message': error}
+        return record
+    
+    # 每一行与单独的请求一样受准入控制约束，批量任务不会挤占交互请求的并发额度
+    started = time.perf_counter()
+    status = 200
+    try:
+        permit = admission.acquire() if admission is not None else None
+    except AdmissionRejected as e:
+        status, payload = 503, error_body(503, str(e))
+    else:
+        try:
+            result = run_chat_completion(body, auth, user_agent, api_key,
+                                         stateless=not body.get('session_id'))
+            payload = chat_completion_body(result)
+            label = result.model if result.model in MODEL_NAMES else 'other'
+            metric_model_requests.inc(label)
+            metric_model_seconds.observe(time.perf_counter() - started, label)
+        except ChoiceCountError as e:
+            status, payload = 400, error_body(400, str(e))
+        except RateLimited as e:
+            status, payload = 429, error_body(429, str(e))
+        except Exception as e:
+            status, payload = 500, error_body(500, str(e))
+        finally:
+            if permit is not None:
+                admission.release(time.monotonic() - permit)
+    if status != 200:
+        metric_errors.inc(str(status))
+    record['response'] = {
+        'status_code': status,
+        'request_id': f'req_{generate_random_string(24)}',
+        'body': payload,
+    }
+    return record
+
+# 所有批量请求共用的工作线程池；线程在首次提交任务时才创建，pre-fork 时各 worker 各自拥有
+batch_executor = ThreadPoolExecutor(max_workers=max(1, BATCH_WORKERS), thread_name_prefix='batch')
+
+def iter_batch_results(groups, total, run_line, workers=BATCH_WORKERS, max_poll=0.05, executor=None):
+    """
+    在共用线程池中执行各组请求，按完成顺序逐行产生 JSONL
+    同一组内的请求按顺序串行执行。每个批量请求最多同时占用 workers 个线程，每个任务只执行一组，
+    完成后再提交下一组，多个批量请求在线程池队列中轮流推进，大批量不会独占线程池。
+    等待结果时产生 StreamPause 而不是阻塞，asyncio 引擎在事件循环中推进生成器时不会被卡住；
+    生成器关闭时不再开始新的请求。
+    """
+    executor = executor or batch_executor
+    results = queue.SimpleQueue()
+    cancelled = threading.Event()
+    pending = deque(groups)
+    
+    def run_next():
+        if cancelled.is_set():
+            return
+        try:
+            group = pending.popleft()
+        except IndexError:
+            return
+        try:
+            for line in group:
+                if cancelled.is_set():
+                    return
+                results.put(run_line(*line))
+        finally:
+            if not cancelled.is_set():
+                executor.submit(run_next)
+    
+    for _ in range(max(1, min(workers, len(groups)))):
+        executor.submit(run_next)
+    try:
+        remaining = total
+        poll = 0.001
+        while remaining:
+            ready = []
+            try:
+                while True:
+                    ready.append(results.get_nowait())
+            except queue.Empty:
+                pass
+            if not ready:
+                yield StreamPause(poll)
+                poll = min(poll * 2, max_poll)
+                continue
+            poll = 0.001
+            remaining -= len(ready)
+            yield b''.join(json_codec.encode(record) + b'\n' for record in ready)
+    finally:
+        cancelled.set()
+
+def handle_batch(headers, rfile):
+    """
+    POST /v1/batch 批量聊天补全
+    请求体为 JSONL，每行格式同 OpenAI Batch API 的输入文件；各行在工作线程池中执行，
+    结果按完成顺序以 JSONL 流式返回，通过 custom_id 与请求对应。
+    body 中 session_id 相同的行按原顺序串行执行，保证同一会话的上下文先后关系；
+    未指定 session_id 的行相互独立，不读写会话（不共用按密钥生成的会话）。流式参数被忽略。
+    """
+    auth = headers.get('Authorization', '')
+    api_key = authenticate(headers)
+    if api_key is None:
+        return error_response(401, 'Invalid or missing API key')
+    
+    # 响应是流式的，请求体须在返回前全部读完
+    lines = []
+    seen = set()
+    for line_no, line in enumerate(rfile, 1):
+        if not line.strip():
+            continue
+        if len(lines) >= BATCH_MAX_LINES:
+            return error_response(400, f'Batch exceeds {BATCH_MAX_LINES} lines')
+        custom_id, body, error = parse_batch_line(line)
+        if custom_id is not None:
+            if custom_id in seen:
+                return error_response(400, f'Duplicate custom_id at line {line_no}: {custom_id}')
+            seen.add(custom_id)
+        lines.append((custom_id, body, error))
+    if not lines:
+        return error_response(400, 'Batch is empty')
+    
+    # 带 session_id 的行按会话分组（组的顺序取首次出现的位置），其余每行单独成组
+    groups = []
+    sessions = {}
+    for line in lines:
+        session_id = line[1].get('session_id') if line[1] else None
+        if not session_id:
+            groups.append([line])
+            continue
+        group = sessions.get(str(session_id))
+        if group is None:
+            group = sessions[str(session_id)] = []
+            groups.append(group)
+        group.append(line)
+    
+    user_agent = headers.get('User-Agent', '')
+    
+    def run_line(custom_id, body, error):
+        return run_batch_line(custom_id, body, error, auth, user_agent, api_key)
+    
+    return Response(200, [
+        ('Content-Type', 'application/x-ndjson'),
+        ('Cache-Control', 'no-store'),
+        ('Access-Control-Allow-Origin', '*'),
+    ], iter_batch_results(groups, len(lines), run_line))
+
+class EmbeddingRequestError(ValueError):
+    """嵌入请求参数无效"""
+
+def parse_embedding_request(body):
+    """
+    校验嵌入请求，返回 (model, texts, dimensions, encoding_format)，参数无效时抛出 EmbeddingRequestError
+    input 可以是字符串、字符串数组、token 数组或 token 数组的数组（token 数组按以空格连接的 token id 文本计算）
+    """
+    model = body.get('model') or 'text-embedding-3-small'
+    if not isinstance(model, str):
+        raise EmbeddingRequestError('model must be a string')
+    default_dimensions, resizable = EMBEDDING_MODELS.get(model, (1536, True))
+    
+    raw = body.get('input')
+    if isinstance(raw, str):
+        raw = [raw]
+    elif isinstance(raw, list) and raw and all(isinstance(t, int) and not isinstance(t, bool) for t in raw):
+        raw = [raw]
+    if not isinstance(raw, list) or not raw:
+        raise EmbeddingRequestError('input must be a string or a non-empty array')
+    if len(raw) > EMBEDDING_MAX_INPUTS:
+        raise EmbeddingRequestError(f'input must have at most {EMBEDDING_MAX_INPUTS} items')
+    texts = []
+    for item in raw:
+        if isinstance(item, list) and item and all(isinstance(t, int) and not isinstance(t, bool) for t in item):
+            item = ' '.join(map(str, item))
+        if not isinstance(item, str) or not item:
+            raise EmbeddingRequestError('input items must be non-empty strings or token arrays')
+        texts.append(item)
+    
+    dimensions = body.get('dimensions')
+    if dimensions is None:
+        dimensions = default_dimensions
+    elif not resizable:
+        raise EmbeddingRequestError(f'{model} does not support the dimensions parameter')
+    elif isinstance(dimensions, bool) or not isinstance(dimensions, int) or not 1 <= dimensions <= default_dimensions:
+        raise EmbeddingRequestError(f'dimensions must be an integer between 1 and {default_dimensions}')
+    
+    encoding_format = body.get('encoding_format') or 'float'
+    if encoding_format not in ('float', 'base64'):
+        raise EmbeddingRequestError("encoding_format must be 'float' or 'base64'")
+    return model, texts, dimensions, encoding_format
+
+def handle_embeddings(headers, rfile):
+    """POST /v1/embeddings"""
+    timer = PhaseTimer()
+    api_key = authenticate(headers)
+    if api_key is None:
+        return error_response(401, 'Invalid or missing API key')
+    
+    post_data = rfile.read()
+    timer.mark('read')
+    try:
+        try:
+            model, texts, dimensions, encoding_format = parse_embedding_request(json_codec.decode(post_data))
+        except EmbeddingRequestError as e:
+            return error_response(400, str(e))
+        timer.mark('parse')
+        
+        profile = token_counter.profile(model)
+        prompt_tokens = sum(token_counter.count(text, profile) for text in texts)
+        timer.mark('prompt')
+        retry_after = rate_limiter.acquire(api_key, prompt_tokens)
+        if retry_after:
+            return error_response(429, f'Rate limit exceeded for {api_key.name}, retry after {retry_after:.1f}s',
+                                  [('Retry-After', str(math.ceil(retry_after)))])
+        timer.mark('ratelimit')
+        
+        vectors = embedder.embed(texts, model, dimensions, encoding_format)
+        timer.mark('embed')
+        payload = json_codec.encode({
+            "object": "list",
+            "data": [{"object": "embedding", "index": index, "embedding": vector}
+                     for index, vector in enumerate(vectors)],
+            "model": model,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "total_tokens": prompt_tokens
+            }
+        })
+        timer.mark('serialize')
+        response = Response(200, [
+            ('Content-Type', 'application/json'),
+            ('Access-Control-Allow-Origin', '*'),
+            ('Server-Timing', timer.header()),
+        ], payload)
+        response.on_close(lambda: timer.log_if_slow(route='/v1/embeddings', model=model, inputs=len(texts)))
+        return response
+    except Exception as e:
+        return error_response(500, str(e))
+
+def track_model(response, model, timer, intent):
+    """记录按模型统计的请求数与延迟（延迟到响应发送完毕为止），并在响应结束时检查是否为慢请求"""
+    label = model if model in MODEL_NAMES else 'other'
+    metric_model_requests.inc(label)
+    
+    def finish():
+        timer.mark('write')
+        metric_model_seconds.observe(timer.elapsed(), label)
+        timer.log_if_slow(route='/v1/chat/completions', model=model, intent=intent,
+                          status=response.status, stream=response.streaming)
+    
+    response.on_close(finish)
+    return response
+
+def measure_stream(chunks):
+    """统计流式响应的 chunk 数与持续时间（StreamPause 不计入 chunk）"""
+    started = time.perf_counter()
+    count = 0
+    try:
+        for chunk in chunks:
+            if not isinstance(chunk, StreamPause):
+                count += 1
+            yield chunk
+    finally:
+        metric_stream_seconds.observe(time.perf_counter() - started)
+        metric_stream_chunks.observe(count)
+        metric_stream_chunks_total.inc(value=count)
+
+def check_admin_auth(headers):
+    """校验管理接口密钥（常量时间比较）"""
+    auth = headers.get('Authorization', '')
+    if not ADMIN_KEY or not auth.startswith('Bearer '):
+        return False
+    return hmac.compare_digest(auth[len('Bearer '):].encode(), ADMIN_KEY.encode())
+
+def iter_sessions_ndjson(flush_size=64 * 1024):
+    """将所有会话编码为 NDJSON，按约 flush_size 字节分块产出"""
+    buffer = []
+    size = 0
+    for session_id, last_access, history, facts in session_store.items():
+        line = json_codec.encode({
+            'session_id': session_id,
+            'last_access': last_access,
+            'history': history,
+            'facts': encode_facts(facts) if facts is not None else None
+        }, pretty=False) + b'\n'
+        buffer.append(line)
+        size += len(line)
+        if size >= flush_size:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+def handle_sessions_export(headers):
+    """GET /admin/sessions/export 以 NDJSON 流式导出全部会话"""
+    if not check_admin_auth(headers):
+        return error_response(401, 'Invalid or missing admin key')
+    return Response(200, [
+        ('Content-Type', 'application/x-ndjson'),
+        ('Cache-Control', 'no-store'),
+    ], iter_sessions_ndjson())
+
+def handle_sessions_import(headers, rfile, batch_size=500):
+    """
+    POST /admin/sessions/import 逐行读取 NDJSON 并分批导入会话
+    请求体可能很大，不会整体缓存后再校验：遇到格式错误的行时，此前的所有合法行均已导入，
+    400 响应中的 imported / skipped 给出这部分的数量，修正后可从出错的行继续导入
+    """
+    if not check_admin_auth(headers):
+        return error_response(401, 'Invalid or missing admin key')
+    
+    imported = 0
+    skipped = 0
+    batch = []
+    error = None
+    for line_no, line in enumerate(rfile, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json_codec.decode(line)
+            batch.append((str(record['session_id']), float(record['last_access']),
+                          list(record.get('history') or []), decode_facts(record.get('facts'))))
+        except (ValueError, KeyError, TypeError) as e:
+            error = f'Invalid NDJSON at line {line_no}: {e}'
+            break
+        if len(batch) >= batch_size:
+            count = session_store.restore_many(batch)
+            imported += count
+            skipped += len(batch) - count
+            batch = []
+    if batch:
+        count = session_store.restore_many(batch)
+        imported += count
+        skipped += len(batch) - count
+    
+    if error is not None:
+        metric_errors.inc('400')
+        body = error_body(400, f'{error} (lines before it were imported)')
+        body.update(imported=imported, skipped=skipped)
+        return Response(400, [
+            ('Content-Type', 'application/json'),
+        ], json_codec.encode(body))
+    return Response(200, [
+        ('Content-Type', 'application/json'),
+    ], json_codec.encode({'imported': imported, 'skipped': skipped}))
+
+def handle_options():
+    """OPTIONS 请求（CORS 预检）"""
+    return Response(200, [
+        ('Access-Control-Allow-Origin', '*'),
+        ('Access-Control-Allow-Methods', 'GET, POST, OPTIONS'),
+        ('Access-Control-Allow-Headers', 'Content-Type, Authorization'),
+    ])
+
+def check_metrics_auth(headers):
+    """未设置 METRICS_KEY 时 /metrics 无需认证"""
+    if not METRICS_KEY:
+        return True
+    auth = headers.get('Authorization', '')
+    return auth.startswith('Bearer ') and hmac.compare_digest(
+        auth[len('Bearer '):].encode(), METRICS_KEY.encode())
+
+def handle_metrics(headers):
+    """GET /metrics 以 Prometheus 文本格式输出指标"""
+    if not check_metrics_auth(headers):
+        return error_response(401, 'Invalid or missing metrics key')
+    return Response(200, [
+        ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+        ('Cache-Control', 'no-store'),
+    ], metrics.render())
+
+def collect_session_stats():
+    sessions, exchanges, chars = session_store.memory_stats()
+    return [(('sessions',), sessions), (('exchanges',), exchanges), (('characters',), chars)]
+
+def collect_admission_stats():
+    if admission is None:
+        return []
+    return [(('limit',), round(admission.limit, 2)), (('in_flight',), admission.in_flight),
+            (('waiting',), admission.waiting), (('latency',), round(admission.latency, 4))]
+
+def collect_cache_stats():
+    if response_cache is None:
+        return []
+    return [(('response', 'hit'), response_cache.hits), (('response', 'miss'), response_cache.misses)]
+
+metrics.callback('cursor2api_session_store', 'In-memory sessions, stored exchanges and history text size',
+                 'gauge', ('kind',), collect_session_stats)
+metrics.callback('cursor2api_admission', 'Admission controller concurrency limit and occupancy',
+                 'gauge', ('kind',), collect_admission_stats)
+metrics.callback('cursor2api_admission_rejected_total', 'Requests rejected by admission control',
+                 'counter', (), lambda: [((), admission.rejected)] if admission is not None else [])
+metrics.callback('cursor2api_cache_lookups_total', 'Cache lookups by cache and result',
+                 'counter', ('cache', 'result'), collect_cache_stats)
+
+# 指标中的路由标签只取已知路径，避免任意路径造成标签基数膨胀
+METRIC_ROUTES = frozenset([
+    '/', '/v1/models', '/v1/chat/completions', '/v1/embeddings', '/v1/batch', '/metrics',
+    '/admin/sessions/export', '/admin/sessions/import',
+])
+
+def dispatch(method, path, headers, rfile, permit=None):
+    """
+    路由入口，供 BaseHTTPRequestHandler 与 asyncio 服务器共用
+    headers 需支持大小写无关的 get()，rfile 为已限定长度的请求体。
+    permit 为传输层对 ADMITTED_ROUTES 中的请求预先申请的准入结果：许可获得时间，
+    或拒绝时的 AdmissionRejected（此时直接返回 503，不读取请求体）；为 None 时在当前线程中申请
+    """
+    started = time.perf_counter()
+    response = route_request(method, path, headers, rfile, permit)
+    route = path if path in METRIC_ROUTES else 'other'
+    metric_requests.inc(route, method, str(response.status))
+    response.on_close(lambda: metric_request_seconds.observe(time.perf_counter() - started, route))
+    return response
+
+def run_admitted(handle, permit=None):
+    """在准入控制下执行 handle()，过载时返回 503"""
+    if admission is None:
+        return handle()
+    try:
+        if isinstance(permit, AdmissionRejected):
+            raise permit
+        return admission.admit(handle, permit)
+    except AdmissionRejected as e:
+        return error_response(503, str(e), [('Retry-After', str(max(1, math.ceil(e.retry_after))))])
+
+def route_request(method, path, headers, rfile, permit=None):
+    """按方法与路径分发到各处理函数"""
+    if method == 'OPTIONS':
+        return handle_options()
+    if method in ('GET', 'HEAD'):
+        if path == '/':
+            return handle_index(headers)
+        if path == '/v1/models':
+            return handle_models(headers)
+        if path == '/admin/sessions/export':
+            return handle_sessions_export(headers)
+        if path == '/metrics':
+            return handle_metrics(headers)
+    elif method == 'POST':
+        if path == '/v1/chat/completions':
+            return run_admitted(lambda: handle_chat_completions(headers, rfile), permit)
+        if path == '/v1/embeddings':
+            return run_admitted(lambda: handle_embeddings(headers, rfile), permit)
+        if path == '/v1/batch':
+            return handle_batch(headers, rfile)
+        if path == '/admin/sessions/import':
+            return handle_sessions_import(headers, rfile)
+    return error_response(404, 'Not found')
+
 class handler(BaseHTTPRequestHandler):
     """Vercel serverless function handler"""
     
+    # 使用 HTTP/1.1 以支持持久连接：普通响应带 Content-Length，流式响应使用 chunked 编码
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+    
+    def handle(self):
+        """
+        处理连接上的请求
+        等待下一个请求时不阻塞在 readline 上，而是轮询套接字：服务器的线程池已满（有新连接在等待线程）时
+        空闲超时缩短为 KEEPALIVE_BUSY_TIMEOUT，到期即关闭连接让出线程，避免空闲的持久连接占满线程池。
+        保留一小段宽限时间而不是立即关闭，是为了不与客户端紧接着发出的下一个请求竞争
+        """
+        self.close_connection = True
+        while self.wait_for_request():
+            self.handle_one_request()
+            if self.close_connection:
+                break
+    
+    def wait_for_request(self):
+        """等待下一个请求到达，返回 False 表示连接空闲超时或需要让出线程"""
+        starved = getattr(self.server, 'starved', None)
+        idle_since = time.monotonic()
+        deadline = idle_since + KEEPALIVE_TIMEOUT
+        while True:
+            # 管线化的请求可能已在读缓冲中，此时套接字上不会再有可读事件
+            self.connection.settimeout(0)
+            try:
+                if self.rfile.peek(1):
+                    return True
+            except OSError:
+                return False
+            finally:
+                self.connection.settimeout(self.timeout)
+            now = time.monotonic()
+            if starved is not None and starved.is_set():
+                deadline = min(deadline, idle_since + KEEPALIVE_BUSY_TIMEOUT)
+            remaining = deadline - now
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([self.connection], [], [], min(remaining, KEEPALIVE_POLL_INTERVAL))
+            if readable:
+                return True
+    
     def do_GET(self):
         """Handle GET requests"""
-        if self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html; charset=utf-8')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(get_html_content().encode())
-            
-        elif self.path == '/v1/models':
-            auth = self.headers.get('Authorization', '')
-            if not auth.startswith('Bearer ') or auth.replace('Bearer ', '') != API_KEY:
-                self.send_error_response(401, 'Invalid or missing API key')
-                return
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            models_list = [{"id": m, "object": "model", "created": int(time.time()), "owned_by": "system"} for m in MODELS]
-            response = {"object": "list", "data": models_list}
-            self.wfile.write(json.dumps(response).encode())
-        else:
-            self.send_error_response(404, 'Not found')
+        self.handle_dispatch('GET')
+    
+    def do_HEAD(self):
+        """Handle HEAD requests"""
+        self.handle_dispatch('HEAD')
     
     def do_POST(self):
         """Handle POST requests"""
-        if self.path == '/v1/chat/completions':
-            auth = self.headers.get('Authorization', '')
-            if not auth.startswith('Bearer ') or auth.replace('Bearer ', '') != API_KEY:
-                self.send_error_response(401, 'Invalid or missing API key')
-                return
-            
-            content_length = int(self.headers.get('Content-Length', 0))
-            post_data = self.rfile.read(content_length)
-            
-            try:
-                body = json.loads(post_data)
-                model = body.get('model', 'gpt-3.5-turbo')
-                messages = body.get('messages', [])
-                stream = body.get('stream', False)
-                
-                # 获取会话ID（改进版，支持自定义session_id）
-                user_agent = self.headers.get('User-Agent', '')
-                session_id = get_session_id(auth, user_agent, body)
-                
-                # 清理过期会话
-                clean_old_sessions()
-                
-                # 更新会话访问时间
-                session_last_access[session_id] = datetime.now()
-                
-                # 获取用户消息
-                user_message = ""
-                for msg in reversed(messages):
-                    if msg.get('role') == 'user':
-                        user_message = msg.get('content', '')
-                        break
-                
-                if not user_message:
-                    user_message = "Hello"
-                
-                # 获取对话历史
-                conversation_history = list(conversation_memory[session_id])
-                
-                # 生成智能响应（传入两种上下文：缓存历史和messages数组）
-                response_content = generate_intelligent_response(
-                    user_message,
-                    model,
-                    conversation_history,
-                    messages  # 传入完整的 messages 数组
-                )
-                
-                # 保存到对话历史
-                conversation_memory[session_id].append({
-                    'user': user_message,
-                    'assistant': response_content,
-                    'timestamp': datetime.now().isoformat()
-                })
-                if stream:
-                    # 流式响应
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'text/event-stream')
-                    self.send_header('Cache-Control', 'no-cache')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    
-                    # 将响应分词并流式输出
-                    words = response_content.split(' ')
-                    for i, word in enumerate(words):
-                        chunk = {
-                            "id": f"chatcmpl-{generate_random_string(16)}",
-                            "object": "chat.completion.chunk",
-                            "created": int(time.time()),
-                            "model": model,
-                            "system_fingerprint": f"fp_{generate_random_string(8)}",
-                            "choices": [{
-                                "delta": {"content": word + (" " if i < len(words)-1 else "")},
-                                "index": 0,
-                                "logprobs": None,
-                                "finish_reason": None
-                            }]
-                        }
-                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
-                    
-                    # 发送结束标记
-                    final_chunk = {
-                        "id": f"chatcmpl-{generate_random_string(16)}",
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": model,
-                        "system_fingerprint": f"fp_{generate_random_string(8)}",
-                        "choices": [{
-                            "delta": {},
-                            "index": 0,
-                            "logprobs": None,
-                            "finish_reason": "stop"
-                        }]
-                    }
-                    self.wfile.write(f"data: {json.dumps(final_chunk)}\n\n".encode())
-                    self.wfile.write(b"data: [DONE]\n\n")
-                    
-                else:
-                    # 非流式响应
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    
-                    # 计算token数量（简单估算）
-                    prompt_tokens = sum(len(m.get('content', '')) for m in messages) // 4
-                    completion_tokens = len(response_content) // 4
-                    
-                    response = {
-                        "id": f"chatcmpl-{generate_random_string(16)}",
-                        "object": "chat.completion",
-                        "created": int(time.time()),
-                        "model": model,
-                        "system_fingerprint": f"fp_{generate_random_string(8)}",
-                        "choices": [{
-                            "index": 0,
-                            "message": {
-                                "role": "assistant",
-                                "content": response_content
-                            },
-                            "logprobs": None,
-                            "finish_reason": "stop"
-                        }],
-                        "usage": {
-                            "prompt_tokens": prompt_tokens,
-                            "completion_tokens": completion_tokens,
-                            "total_tokens": prompt_tokens + completion_tokens
-                        }
-                    }
-                    self.wfile.write(json.dumps(response, indent=2).encode())
-                    
-            except Exception as e:
-                self.send_error_response(500, str(e))
-        else:
-            self.send_error_response(404, 'Not found')
+        self.handle_dispatch('POST')
     
     def do_OPTIONS(self):
         """Handle OPTIONS requests (CORS preflight)"""
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
-        self.end_headers()
+        self.handle_dispatch('OPTIONS')
+    
+    def handle_dispatch(self, method):
+        """读取请求体并交给 dispatch 处理"""
+        body = RequestBody(self.rfile, int(self.headers.get('Content-Length', 0) or 0))
+        response = dispatch(method, self.path, self.headers, body)
+        
+        # 连接复用前必须读完本次请求体，否则剩余数据会被当作下一个请求解析
+        if self.headers.get('Transfer-Encoding') or body.remaining > MAX_DRAIN_SIZE:
+            self.close_connection = True
+        elif body.remaining:
+            body.drain()
+        self.send_http_response(response)
+    
+    def send_http_response(self, response):
+        """发送 Response 对象"""
+        try:
+            chunked = False
+            self.send_response(response.status)
+            for name, value in response.headers:
+                self.send_header(name, value)
+            if response.status == 304:
+                pass  # 304 没有响应体
+            elif not response.streaming:
+                self.send_header('Content-Length', str(len(response.body)))
+            elif self.request_version == 'HTTP/1.1':
+                chunked = True
+                self.send_header('Transfer-Encoding', 'chunked')
+            else:
+                # HTTP/1.0 客户端不支持 chunked，只能以关闭连接标识响应结束
+                self.close_connection = True
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+            self.end_headers()
+            
+            if self.command == 'HEAD':
+                pass
+            elif not response.streaming:
+                self.wfile.write(response.body)
+            elif chunked:
+                # 套接字写入是阻塞的：客户端读得慢时这里阻塞，生成器也随之停止产出
+                for chunk in response.body:
+                    if isinstance(chunk, StreamPause):
+                        time.sleep(chunk)
+                    elif chunk:
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                self.wfile.write(b'0\r\n\r\n')
+            else:
+                for chunk in response.body:
+                    if isinstance(chunk, StreamPause):
+                        time.sleep(chunk)
+                    else:
+                        self.wfile.write(chunk)
+        finally:
+            response.close()
     
     def send_error_response(self, code, message):
         """发送错误响应"""
-        self.send_response(code)
-        self.send_header('Content-Type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(json.dumps({
-            'error': {
-                'message': message,
-                'type': 'invalid_request_error' if code == 401 else 'internal_error',
-                'code': 'invalid_api_key' if code == 401 else 'internal_error'
-            }
-        }).encode())
-                    
\ No newline at end of file
+        self.send_http_response(error_response(code, message))
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Cursor2API 压测工具
+启动服务器（子进程或当前进程内），以固定并发压测各端点，输出 RPS、延迟分位数与 SSE 首字节时间，
+结果可保存为 JSON，用于比较不同版本或不同服务模式
+仅依赖标准库
+
+用法:
+    python benchmark.py                                  # 启动本地服务器并压测全部场景
+    python benchmark.py -c 64 -d 20 -e asyncio -w 4      # 64 并发，每个场景 20 秒，asyncio 引擎 4 进程
+    python benchmark.py --url http://127.0.0.1:8001      # 压测已运行的服务器（需设置 API_KEY）
+    python benchmark.py -o base.json                     # 保存结果
+    python benchmark.py --compare base.json new.json     # 比较两次结果
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import secrets
+import argparse
+import platform
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlsplit
+
+from server import DEFAULT_BACKLOG, DEFAULT_THREADS, ENGINES
+
+SCENARIOS = ('chat', 'chat-stream', 'models', 'index')
+PERCENTILES = (50, 95, 99, 99.9)
+PROMPTS = (
+    "你好",
+    "计算 (12 + 30) * 7",
+    "Hello, what model are you?",
+    "写一段Python代码",
+)
+
+
+def scenario_request(name, api_key, index):
+    """返回场景的 (method, path, body, headers)"""
+    headers = {'Authorization': f'Bearer {api_key}'}
+    if name in ('chat', 'chat-stream'):
+        body = json.dumps({
+            'model': 'gpt-5',
+            'messages': [{'role': 'user', 'content': PROMPTS[index % len(PROMPTS)]}],
+            'stream': name == 'chat-stream',
+            # 每个压测线程使用独立会话，避免会话历史在所有请求间共享
+            'session_id': f'bench-{index}',
+        }).encode()
+        headers['Content-Type'] = 'application/json'
+        return 'POST', '/v1/chat/completions', body, headers
+    if name == 'models':
+        return 'GET', '/v1/models', None, headers
+    return 'GET', '/', None, {}
+
+
+def percentile(sorted_values, p):
+    """最近秩法分位数"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[min(len(sorted_values), int(rank)) - 1]
+
+
+def summarize(latencies, ttfbs, errors, elapsed):
+    """elapsed 为实测的计量时长：从开始计量到最后一个请求完成（截止时仍在进行的请求也计入结果）"""
+    latencies.sort()
+    ttfbs.sort()
+    result = {
+        'requests': len(latencies),
+        'errors': errors,
+        'elapsed_s': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+            'max': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+    }
+    for p in PERCENTILES:
+        result['latency_ms'][f'p{p:g}'] = round(percentile(latencies, p) * 1000, 3)
+    if ttfbs:
+        result['ttfb_ms'] = {f'p{p:g}': round(percentile(ttfbs, p) * 1000, 3) for p in PERCENTILES}
+    return result
+
+
+class Worker(threading.Thread):
+    """一个压测线程：使用一条持久连接顺序发送请求，直到截止时间"""
+
+    def __init__(self, name, host, port, api_key, index, deadline, measure_from):
+        super().__init__(daemon=True)
+        self.scenario = name
+        self.host = host
+        self.port = port
+        self.api_key = api_key
+        self.index = index
+        self.deadline = deadline
+        self.measure_from = measure_from
+        self.latencies = []
+        self.ttfbs = []
+        self.errors = 0
+        self.last_end = measure_from  # 计入结果的请求中最后一个的完成时间
+
+    def _connect(self):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        conn.connect()
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
+    def run(self):
+        method, path, body, headers = scenario_request(self.scenario, self.api_key, self.index)
+        conn = None
+        while True:
+            start = time.perf_counter()
+            if start >= self.deadline:
+                break
+            try:
+                if conn is None:
+                    conn = self._connect()
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                first = response.read1(1) if self.scenario == 'chat-stream' else b''
+                ttfb = time.perf_counter() - start
+                response.read()
+                ok = response.status == 200 and (first or self.scenario != 'chat-stream')
+                if response.will_close:
+                    conn.close()
+                    conn = None
+            except (OSError, http.client.HTTPException):
+                ok = False
+                if conn is not None:
+                    conn.close()
+                conn = None
+            end = time.perf_counter()
+            # 预热阶段的请求不计入结果
+            if start < self.measure_from:
+                continue
+            self.last_end = max(self.last_end, end)
+            if not ok:
+                self.errors += 1
+                continue
+            self.latencies.append(end - start)
+            if self.scenario == 'chat-stream':
+                self.ttfbs.append(ttfb)
+        if conn is not None:
+            conn.close()
+
+
+def run_scenario(name, host, port, api_key, concurrency, duration, warmup):
+    now = time.perf_counter()
+    measure_from = now + warmup
+    deadline = measure_from + duration
+    workers = [Worker(name, host, port, api_key, i, deadline, measure_from) for i in range(concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    latencies = [x for w in workers for x in w.latencies]
+    ttfbs = [x for w in workers for x in w.ttfbs]
+    # 截止时仍在进行的请求会在 deadline 之后完成并被计入，按实际时长而不是名义的 duration 计算吞吐
+    elapsed = max(w.last_end for w in workers) - measure_from
+    return summarize(latencies, ttfbs, sum(w.errors for w in workers), elapsed)
+
+
+def free_port(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(host, port, timeout=15.0, process=None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'服务器进程已退出 (exit code {process.returncode})')
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'服务器未在 {timeout:.0f} 秒内启动')
+
+
+def boot_subprocess(host, port, api_key, args):
+    """通过 start.py 启动服务器子进程"""
+    env = os.environ.copy()
+    env['API_KEY'] = api_key
+    command = [
+        sys.executable, 'start.py', 'dev', '--skip-checks', '-H', host, '-p', str(port),
+        '-e', args.engine, '-w', str(args.workers), '-t', str(args.threads),
+        '--backlog', str(args.backlog),
+    ]
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(host, port, process=process)
+    return process
+
+
+def boot_in_process(host, port, api_key, args):
+    """在当前进程的后台线程中启动服务器（与压测线程共享 GIL，结果偏保守）"""
+    os.environ['API_KEY'] = api_key
+    from server import make_server
+    server = make_server(args.engine, host, port, threads=args.threads, backlog=args.backlog)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    wait_for_port(host, port)
+    return None
+
+
+def print_results(results):
+    print(f"\n{'场景':<12} {'请求数':>8} {'错误':>6} {'RPS':>10} {'p50':>9} {'p95':>9} {'p99':>9} {'p99.9':>9} {'TTFB p50':>9} {'TTFB p99':>9}")
+    print('-' * 100)
+    for name, r in results['scenarios'].items():
+        lat = r['latency_ms']
+        ttfb = r.get('ttfb_ms', {})
+        print(f"{name:<12} {r['requests']:>8} {r['errors']:>6} {r['rps']:>10.1f} "
+              f"{lat['p50']:>9.2f} {lat['p95']:>9.2f} {lat['p99']:>9.2f} {lat['p99.9']:>9.2f} "
+              f"{ttfb.get('p50', 0):>9.2f} {ttfb.get('p99', 0):>9.2f}")
+    print('(延迟单位: 毫秒)')
+
+
+def compare(base_path, new_path):
+    """比较两个结果文件的 RPS 与尾延迟"""
+    with open(base_path, encoding='utf-8') as f:
+        base = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+    print(f"基准: {base_path} ({base.get('label') or base['config']})")
+    print(f"对比: {new_path} ({new.get('label') or new['config']})")
+
+    def change(old, cur):
+        return f'{(cur - old) / old * 100:+.1f}%' if old else 'n/a'
+
+    print(f"\n{'场景':<12} {'RPS':>22} {'p50 (ms)':>24} {'p99 (ms)':>24}")
+    print('-' * 86)
+    for name, cur in new['scenarios'].items():
+        old = base['scenarios'].get(name)
+        if old is None:
+            continue
+        cols = []
+        for getter in (lambda r: r['rps'], lambda r: r['latency_ms']['p50'], lambda r: r['latency_ms']['p99']):
+            a, b = getter(old), getter(cur)
+            cols.append(f'{a:.1f} → {b:.1f} {change(a, b):>7}')
+        print(f'{name:<12} {cols[0]:>22} {cols[1]:>24} {cols[2]:>24}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cursor2API 压测工具')
+    parser.add_argument('--url', help='压测已运行的服务器（不启动本地服务器），需设置 API_KEY 环境变量')
+    parser.add_argument('--boot', choices=['subprocess', 'inprocess'], default='subprocess',
+                        help='本地服务器启动方式 (默认: subprocess)')
+    parser.add_argument('-s', '--scenarios', default=','.join(SCENARIOS),
+                        help=f'逗号分隔的场景: {", ".join(SCENARIOS)} (默认: 全部)')
+    parser.add_argument('-c', '--concurrency', type=int, default=16, help='并发连接数 (默认: 16)')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='每个场景的压测时长，秒 (默认: 10)')
+    parser.add_argument('--warmup', type=float, default=1, help='每个场景的预热时长，秒 (默认: 1)')
+    parser.add_argument('-e', '--engine', choices=ENGINES, default='threaded', help='服务器引擎 (默认: threaded)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='服务器工作进程数 (默认: 1)')
+    parser.add_argument('-t', '--threads', type=int, default=DEFAULT_THREADS,
+                        help=f'每进程线程数 (默认: {DEFAULT_THREADS})')
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG,
+                        help=f'监听队列长度 (默认: {DEFAULT_BACKLOG})')
+    parser.add_argument('-l', '--label', default='', help='结果标签，写入 JSON')
+    parser.add_argument('-o', '--output', help='结果 JSON 文件路径')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='比较两个结果文件后退出')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'未知场景: {", ".join(sorted(unknown))}')
+
+    process = None
+    if args.url:
+        parts = urlsplit(args.url)
+        host, port = parts.hostname, parts.port or 80
+        api_key = os.environ.get('API_KEY', '')
+        if not api_key:
+            parser.error('使用 --url 时需设置 API_KEY 环境变量')
+        mode = 'external'
+    else:
+        host = '127.0.0.1'
+        port = free_port(host)
+        api_key = 'sk-bench-' + secrets.token_hex(16)
+        print(f"🚀 启动服务器: {args.engine} 引擎 × {args.workers} 进程 × {args.threads} 线程 ({args.boot})")
+        boot = boot_subprocess if args.boot == 'subprocess' else boot_in_process
+        process = boot(host, port, api_key, args)
+        mode = args.boot
+
+    results = {
+        'label': args.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'config': {
+            'mode': mode,
+            'engine': args.engine if mode != 'external' else None,
+            'workers': args.workers if mode != 'external' else None,
+            'threads': args.threads if mode != 'external' else None,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'warmup': args.warmup,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'scenarios': {},
+    }
+    try:
+        for name in scenarios:
+            print(f"⏱️  {name}: {args.concurrency} 并发 × {args.duration:g} 秒 ...")
+            results['scenarios'][name] = run_scenario(name, host, port, api_key, args.concurrency,
+                                                      args.duration, args.warmup)
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 结果已保存到 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,10 @@ Cursor2API 超简单快速启动脚本
 
 import os
 import sys
+import argparse
 from pathlib import Path
 
-def quick_start():
+def quick_start(workers=1, threads=None, engine='threaded', backlog=None, nodelay=True):
     """快速启动服务器"""
     print("\n🚀 Cursor2API 快速启动中...\n")
     
@@ -29,8 +30,7 @@ def quick_start():
     
     # 快速启动服务器
     try:
-        from api.index import handler
-        from http.server import HTTPServer
+        from server import DEFAULT_BACKLOG, DEFAULT_THREADS, serve
         
         port = 8001
         host = '127.0.0.1'
@@ -42,8 +42,8 @@ def quick_start():
         print(f"   curl http://{host}:{port}/v1/models -H 'Authorization: Bearer YOUR_API_KEY'")
         print(f"\n⚠️  按 Ctrl+C 停止服务器\n")
         
-        server = HTTPServer((host, port), handler)
-        server.serve_forever()
+        serve(host, port, workers=workers, threads=threads or DEFAULT_THREADS,
+              backlog=backlog or DEFAULT_BACKLOG, nodelay=nodelay, engine=engine)
         
     except KeyboardInterrupt:
         print("\n\n👋 服务器已停止")
@@ -54,4 +54,13 @@ def quick_start():
         print(f"❌ 启动失败：{e}")
 
 if __name__ == '__main__':
-    quick_start()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Cursor2API 快速启动')
+    parser.add_argument('-e', '--engine', choices=['threaded', 'asyncio'], default='threaded',
+                        help='服务器引擎 (默认: threaded)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='工作进程数 (默认: 1)')
+    parser.add_argument('-t', '--threads', type=int, default=None, help='每个进程的线程数')
+    parser.add_argument('--backlog', type=int, default=None, help='监听队列长度')
+    parser.add_argument('--no-nodelay', dest='nodelay', action='store_false',
+                        help='不对连接设置 TCP_NODELAY')
+    args = parser.parse_args()
+    quick_start(args.workers, args.threads, args.engine, args.backlog, args.nodelay)
\ No newline at end of file
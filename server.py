@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+"""
+Cursor2API 生产服务模式
+多进程预派生 (pre-fork) + 每进程有界线程池，进程间通过 SO_REUSEPORT 共享监听端口
+另提供基于 asyncio 的单线程事件循环引擎，支持 HTTP/1.1 keep-alive 与管线化
+"""
+
+import io
+import os
+import sys
+import time
+import signal
+import socket
+import asyncio
+import tempfile
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http import HTTPStatus
+from http.server import HTTPServer
+
+DEFAULT_THREADS = 16
+DEFAULT_BACKLOG = 1024
+DEFAULT_KEEPALIVE_TIMEOUT = 15.0
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 1024 * 1024 * 1024
+SPOOL_SIZE = 1024 * 1024  # 超过此大小的请求体写入临时文件，保证大批量导入时内存恒定
+# 写缓冲水位：流式响应积压超过高水位时暂停生成，降到低水位以下再继续
+WRITE_HIGH_WATER = 64 * 1024
+WRITE_LOW_WATER = 16 * 1024
+WRITE_TIMEOUT = 60.0  # 客户端长时间不读取时放弃该连接，避免慢连接一直占用资源
+ENGINES = ('threaded', 'asyncio')
+
+
+class PooledHTTPServer(HTTPServer):
+    """使用有界线程池处理连接的 HTTP 服务器
+
+    线程全部繁忙时不再 accept，新连接留在内核 backlog 中排队，
+    而不是在进程内无限堆积。此时设置 starved，正在等待下一个请求的空闲持久连接
+    会被关闭以让出线程（见 api.index.handler.wait_for_request）。
+    """
+
+    def __init__(self, server_address, handler_class, threads: int = DEFAULT_THREADS,
+                 backlog: int = DEFAULT_BACKLOG, nodelay: bool = True,
+                 reuse_port: bool = False, bind_and_activate: bool = True):
+        self.request_queue_size = backlog
+        self.nodelay = nodelay
+        self.reuse_port = reuse_port
+        self._slots = threading.BoundedSemaphore(threads)
+        self.starved = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='cursor2api')
+        super().__init__(server_address, handler_class, bind_and_activate)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        if self.nodelay:
+            try:
+                request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass
+        # 占用一个线程槽位；线程池满时阻塞 accept 循环，并通知空闲连接让出线程
+        if not self._slots.acquire(blocking=False):
+            self.starved.set()
+            try:
+                self._slots.acquire()
+            finally:
+                self.starved.clear()
+        self._pool.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False)
+
+
+class BadRequest(Exception):
+    """请求无法解析，需要以指定状态码响应并关闭连接"""
+
+    def __init__(self, status: int):
+        super().__init__(status)
+        self.status = status
+
+
+class AsyncHTTPServer:
+    """基于 asyncio 的 HTTP/1.1 服务器
+
+    复用 api.index.dispatch 的路由；每个连接是一个协程，按顺序处理管线化请求，
+    流式响应逐块写出并等待 drain()，慢客户端只占用缓冲区而不占用线程。
+    """
+
+    def __init__(self, server_address, backlog: int = DEFAULT_BACKLOG, nodelay: bool = True,
+                 reuse_port: bool = False, keepalive_timeout: float = DEFAULT_KEEPALIVE_TIMEOUT,
+                 threads: int = DEFAULT_THREADS):
+        from api.index import ADMITTED_ROUTES, AdmissionRejected, StreamPause, admission, dispatch
+        self.dispatch = dispatch
+        self.pause_type = StreamPause
+        self.rejected_type = AdmissionRejected
+        self.admission = admission
+        self.admitted_routes = ADMITTED_ROUTES
+        # dispatch 可能阻塞（SQLite 读写等），放到线程池中执行，事件循环只负责收发数据；
+        # 准入许可在交给线程池之前于事件循环中申请，排队的请求不占用线程，也不会堆积在线程池队列里
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='cursor2api')
+        self.server_address = server_address
+        self.backlog = backlog
+        self.nodelay = nodelay
+        self.reuse_port = reuse_port
+        self.keepalive_timeout = keepalive_timeout
+        self._date = (0, '')
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def server_close(self):
+        pass
+
+    async def _serve(self):
+        host, port = self.server_address
+        server = await asyncio.start_server(
+            self._handle_connection, host, port, backlog=self.backlog,
+            reuse_port=self.reuse_port or None, limit=MAX_HEADER_SIZE)
+        async with server:
+            await server.serve_forever()
+
+    def _http_date(self) -> str:
+        now = int(time.time())
+        if self._date[0] != now:
+            self._date = (now, formatdate(now, usegmt=True))
+        return self._date[1]
+
+    async def _handle_connection(self, reader, writer):
+        writer.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER, low=WRITE_LOW_WATER)
+        if self.nodelay:
+            sock = writer.get_extra_info('socket')
+            if sock is not None:
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                except OSError:
+                    pass
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                                  self.keepalive_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._write_simple(writer, 431)
+                    break
+                try:
+                    keep_alive = await self._handle_request(head, reader, writer)
+                except BadRequest as e:
+                    await self._write_simple(writer, e.status)
+                    break
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, head: bytes, reader, writer) -> bool:
+        """处理一个请求，返回连接是否保持"""
+        # 管线化请求之间允许出现多余的空行
+        request_line, _, header_bytes = head.lstrip(b'\r\n').partition(b'\r\n')
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            raise BadRequest(400)
+        if not version.startswith('HTTP/1.'):
+            raise BadRequest(505)
+        headers = http.client.parse_headers(io.BytesIO(header_bytes))
+
+        connection = headers.get('Connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = 'keep-alive' in connection
+        else:
+            keep_alive = 'close' not in connection
+
+        if headers.get('Expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        body = await self._read_body(headers, reader)
+        try:
+            permit = None
+            if self.admission is not None and (method, target) in self.admitted_routes:
+                permit = await self._admit()
+            if isinstance(permit, self.rejected_type):
+                # 被拒绝的请求直接生成 503，不经过线程池
+                response = self.dispatch(method, target, headers, body, permit)
+            else:
+                response = await asyncio.get_running_loop().run_in_executor(
+                    self._pool, self.dispatch, method, target, headers, body, permit)
+        finally:
+            body.close()
+        try:
+            return await self._write_response(writer, response, version, keep_alive,
+                                              head_only=(method == 'HEAD'))
+        finally:
+            response.close()
+
+    async def _admit(self):
+        """在事件循环中申请准入许可，返回许可获得时间，被拒绝时返回 AdmissionRejected"""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            # 由归还许可的线程调用
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        try:
+            if not self.admission.try_acquire(notify):
+                try:
+                    await asyncio.wait_for(asyncio.shield(granted), self.admission.queue_timeout)
+                except asyncio.TimeoutError:
+                    self.admission.expire(notify)
+        except self.rejected_type as e:
+            return e
+        except asyncio.CancelledError:
+            # 连接在排队时被关闭：撤销排队，许可恰好已授予时归还
+            if not self.admission.cancel(notify):
+                self.admission.release()
+            raise
+        return time.monotonic()
+
+    async def _read_body(self, headers, reader):
+        """读取请求体到 SpooledTemporaryFile，返回定位到开头的文件对象"""
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        size = 0
+        try:
+            if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+                while True:
+                    line = await reader.readline()
+                    try:
+                        chunk_size = int(line.split(b';', 1)[0].strip(), 16)
+                    except ValueError:
+                        raise BadRequest(400)
+                    if chunk_size == 0:
+                        # 丢弃 trailer
+                        while (await reader.readline()).strip():
+                            pass
+                        break
+                    size += chunk_size
+                    if size > MAX_BODY_SIZE:
+                        raise BadRequest(413)
+                    await self._copy(reader, body, chunk_size)
+                    await reader.readexactly(2)
+            else:
+                try:
+                    length = int(headers.get('Content-Length', 0) or 0)
+                except ValueError:
+                    raise BadRequest(400)
+                if length < 0:
+                    raise BadRequest(400)
+                if length > MAX_BODY_SIZE:
+                    raise BadRequest(413)
+                await self._copy(reader, body, length)
+        except BaseException:
+            body.close()
+            raise
+        body.seek(0)
+        return body
+
+    async def _copy(self, reader, body, length: int):
+        while length > 0:
+            data = await reader.readexactly(min(length, 65536))
+            body.write(data)
+            length -= len(data)
+
+    def _status_line(self, status: int) -> str:
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ''
+        return f'HTTP/1.1 {status} {reason}'
+
+    async def _write_response(self, writer, response, version: str, keep_alive: bool,
+                              head_only: bool = False) -> bool:
+        lines = [self._status_line(response.status),
+                 f'Date: {self._http_date()}']
+        lines.extend(f'{name}: {value}' for name, value in response.headers)
+        chunked = False
+        if response.status == 304:
+            pass  # 304 没有响应体
+        elif not response.streaming:
+            lines.append(f'Content-Length: {len(response.body)}')
+        elif version == 'HTTP/1.1':
+            chunked = True
+            lines.append('Transfer-Encoding: chunked')
+        else:
+            # HTTP/1.0 客户端只能以关闭连接标识流式响应结束
+            keep_alive = False
+        lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+        if head_only:
+            await writer.drain()
+        elif not response.streaming:
+            writer.write(response.body)
+            await writer.drain()
+        else:
+            # 每写一个 chunk 都等待缓冲降到水位以下，生成器在此期间不会被继续推进
+            for chunk in response.body:
+                if isinstance(chunk, self.pause_type):
+                    await asyncio.sleep(chunk)
+                    continue
+                if not chunk:
+                    continue
+                if chunked:
+                    writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                else:
+                    writer.write(chunk)
+                await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        return keep_alive
+
+    async def _write_simple(self, writer, status: int):
+        lines = [self._status_line(status), f'Date: {self._http_date()}',
+                 'Content-Length: 0', 'Connection: close']
+        try:
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+def make_server(engine: str, host: str, port: int, threads: int = DEFAULT_THREADS,
+                backlog: int = DEFAULT_BACKLOG, nodelay: bool = True, reuse_port: bool = False):
+    """按引擎名称创建服务器
+
+    准入控制的并发上限被限制在 threads 以内。线程引擎只有在连接线程读出请求后才能申请许可，
+    因此额外预留与准入队列等长的连接线程作为有界的等待区：排队的请求在准入控制中等待或被提前拒绝，
+    而不是停留在内核 backlog 中不可见；同时处理的请求数仍不超过 threads。
+    """
+    from api.index import configure_admission
+    queue_size = configure_admission(threads)
+    if engine == 'asyncio':
+        return AsyncHTTPServer((host, port), backlog=backlog, nodelay=nodelay,
+                               reuse_port=reuse_port, threads=threads)
+    from api.index import handler
+    return PooledHTTPServer((host, port), handler, threads=threads + queue_size, backlog=backlog,
+                            nodelay=nodelay, reuse_port=reuse_port)
+
+
+def reuse_port_supported() -> bool:
+    """当前平台是否支持 fork + SO_REUSEPORT"""
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+
+
+def _shutdown_app():
+    """退出前提交应用中尚未写入的数据（SQLite 会话后端的待写队列）"""
+    from api.index import shutdown
+    shutdown()
+
+
+def _run_worker(server):
+    """在当前进程内运行服务器直到被终止"""
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        _shutdown_app()
+
+
+def _spawn_worker(engine: str, host: str, port: int, threads: int, backlog: int,
+                  nodelay: bool) -> int:
+    """派生一个工作进程，每个进程绑定自己的 SO_REUSEPORT 监听套接字"""
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 0
+    try:
+        server = make_server(engine, host, port, threads=threads, backlog=backlog,
+                             nodelay=nodelay, reuse_port=True)
+        _run_worker(server)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 0
+    except BaseException as e:
+        print(f"❌ 工作进程 {os.getpid()} 启动失败: {e}", file=sys.stderr)
+        code = 1
+    os._exit(code)
+
+
+def serve(host: str = '127.0.0.1', port: int = 8001, workers: int = 1,
+          threads: int = DEFAULT_THREADS, backlog: int = DEFAULT_BACKLOG, nodelay: bool = True,
+          engine: str = 'threaded'):
+    """启动服务器
+
+    engine 为 'threaded'（线程池）或 'asyncio'（事件循环）。
+    workers > 1 时派生多个工作进程（需要 fork 与 SO_REUSEPORT），
+    由内核在各进程的监听套接字之间分配连接；父进程只负责监控和重启工作进程。
+    """
+    if workers > 1 and not reuse_port_supported():
+        print("⚠️  当前平台不支持 fork/SO_REUSEPORT，回退到单进程模式", file=sys.stderr)
+        workers = 1
+
+    if workers <= 1:
+        server = make_server(engine, host, port, threads=threads, backlog=backlog,
+                             nodelay=nodelay)
+        # SIGTERM 转为 SystemExit，以便执行下面的清理
+        previous = signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        try:
+            server.serve_forever()
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            server.server_close()
+            _shutdown_app()
+        return
+
+    children = {}
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    previous = signal.signal(signal.SIGTERM, stop)
+    try:
+        for _ in range(workers):
+            children[_spawn_worker(engine, host, port, threads, backlog, nodelay)] = time.monotonic()
+
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            started = children.pop(pid, None)
+            if stopping or started is None:
+                continue
+            # 启动后立即退出通常是端口绑定失败，此时不再重启以免无限循环
+            if time.monotonic() - started < 1.0:
+                print(f"❌ 工作进程 {pid} 启动后立即退出，正在停止服务", file=sys.stderr)
+                stop()
+                continue
+            print(f"⚠️  工作进程 {pid} 异常退出 (status={status})，正在重启", file=sys.stderr)
+            children[_spawn_worker(engine, host, port, threads, backlog, nodelay)] = time.monotonic()
+    except KeyboardInterrupt:
+        stop()
+        for pid in list(children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        raise
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+
+def add_server_arguments(parser):
+    """为 argparse 解析器添加服务模式相关参数"""
+    parser.add_argument('-e', '--engine', choices=ENGINES, default='threaded',
+                        help='服务器引擎: threaded(线程池), asyncio(事件循环) (默认: threaded)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='工作进程数，>1 时启用 pre-fork 模式 (默认: 1)')
+    parser.add_argument('-t', '--threads', type=int, default=DEFAULT_THREADS,
+                        help=f'每个进程的线程池大小 (默认: {DEFAULT_THREADS})')
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG,
+                        help=f'监听队列长度 (默认: {DEFAULT_BACKLOG})')
+    parser.add_argument('--no-nodelay', dest='nodelay', action='store_false',
+                        help='不对连接设置 TCP_NODELAY')
+    return parser
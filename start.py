@@ -15,6 +15,8 @@ import argparse
 import socket
 from typing import Optional
 
+from server import DEFAULT_BACKLOG, DEFAULT_THREADS, add_server_arguments, serve
+
 # ANSI 颜色代码
 class Colors:
     HEADER = '\033[95m'
@@ -161,7 +163,9 @@ def check_dependencies():
     
     return True
 
-def start_dev_server(port: int = 8001, host: str = '127.0.0.1'):
+def start_dev_server(port: int = 8001, host: str = '127.0.0.1', workers: int = 1,
+                     threads: int = DEFAULT_THREADS, backlog: int = DEFAULT_BACKLOG,
+                     nodelay: bool = True, engine: str = 'threaded'):
     """启动开发服务器"""
     print(f"\n{Colors.OKBLUE}🚀 正在启动开发服务器...{Colors.ENDC}")
     
@@ -181,6 +185,10 @@ def start_dev_server(port: int = 8001, host: str = '127.0.0.1'):
     print(f"{Colors.OKCYAN}📝 API 端点:{Colors.ENDC}")
     print(f"    - 获取模型: GET http://{host}:{port}/v1/models")
     print(f"    - 聊天完成: POST http://{host}:{port}/v1/chat/completions")
+    if engine == 'asyncio':
+        print(f"{Colors.OKCYAN}⚙️  服务模式: asyncio 引擎 × {workers} 个进程，每进程 {threads} 个处理线程 (backlog={backlog}){Colors.ENDC}")
+    else:
+        print(f"{Colors.OKCYAN}⚙️  服务模式: {workers} 个进程 × {threads} 个线程 (backlog={backlog}){Colors.ENDC}")
     print(f"\n{Colors.WARNING}按 Ctrl+C 停止服务器{Colors.ENDC}\n")
     
     try:
@@ -194,12 +202,9 @@ def start_dev_server(port: int = 8001, host: str = '127.0.0.1'):
                 pass
         
         # 启动服务器
-        from api.index import handler
-        from http.server import HTTPServer
-        
-        server = HTTPServer((host, port), handler)
         print(f"{Colors.OKGREEN}服务器正在运行...{Colors.ENDC}")
-        server.serve_forever()
+        serve(host, port, workers=workers, threads=threads, backlog=backlog, nodelay=nodelay,
+              engine=engine)
         
     except KeyboardInterrupt:
         print(f"\n{Colors.WARNING}⚠️  服务器已停止{Colors.ENDC}")
@@ -261,6 +266,7 @@ def main():
                        help='服务器主机地址 (默认: 127.0.0.1)')
     parser.add_argument('--skip-checks', action='store_true',
                        help='跳过环境和依赖检查')
+    add_server_arguments(parser)
     
     args = parser.parse_args()
     
@@ -279,7 +285,8 @@ def main():
     
     # 根据模式执行不同操作
     if args.mode == 'dev':
-        start_dev_server(args.port, args.host)
+        start_dev_server(args.port, args.host, workers=args.workers, threads=args.threads,
+                         backlog=args.backlog, nodelay=args.nodelay, engine=args.engine)
     elif args.mode == 'vercel':
         start_vercel_dev()
     elif args.mode == 'test':
@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 """
 测试所有支持的模型
+从 /v1/models 获取模型列表，将 模型 × 测试消息 × (流式/非流式) 的组合并发执行，
+输出按模型统计的延迟表和机器可读的 JSON 汇总；有失败时以非零状态码退出
 """
 import requests
 import json
 import time
 import os
 import sys
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # API配置 - 从环境变量读取，或使用默认值
 API_URL = os.getenv("API_URL", "http://127.0.0.1:8001")
@@ -18,204 +23,212 @@ if not API_KEY or API_KEY == "your-api-key-here":
     print("   例如：export API_KEY=your-actual-api-key")
     sys.exit(1)
 
-# 所有支持的模型
-MODELS = [
-    "gpt-5",
-    "gpt-5-codex",
-    "gpt-5-mini",
-    "gpt-5-nano",
-    "gpt-4.1",
-    "gpt-4o",
-    "claude-3.5-sonnet",
-    "claude-3.5-haiku",
-    "claude-3.7-sonnet",
-    "claude-4-sonnet",
-    "claude-4-opus",
-    "claude-4.1-opus",
-    "gemini-2.5-pro",
-    "gemini-2.5-flash",
-    "o3",
-    "o4-mini",
-    "deepseek-r1",
-    "deepseek-v3.1",
-    "kimi-k2-instruct",
-    "grok-3",
-    "grok-3-mini",
-    "grok-4",
-    "code-supernova-1-million"
+# 测试不同类型的消息
+TEST_MESSAGES = [
+    "Hello, what model are you?",
+    "写一段Python代码",
+    "Explain quantum computing",
 ]
 
-def test_models_endpoint():
-    """测试模型列表端点"""
+# 每个线程复用自己的 HTTP 连接
+_local = threading.local()
+
+def get_session():
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = _local.session = requests.Session()
+        session.headers["Authorization"] = f"Bearer {API_KEY}"
+    return session
+
+def fetch_models():
+    """测试模型列表端点，返回模型 ID 列表（失败时返回 None）"""
     print("=" * 60)
     print("测试 /v1/models 端点")
     print("=" * 60)
-    
-    headers = {
-        "Authorization": f"Bearer {API_KEY}"
-    }
-    
+
     try:
-        response = requests.get(f"{API_URL}/v1/models", headers=headers)
+        response = get_session().get(f"{API_URL}/v1/models", timeout=10)
         if response.status_code == 200:
             data = response.json()
+            # 嵌入模型不支持聊天补全，不参与测试
+            models = [model['id'] for model in data['data'] if not model['id'].startswith('text-embedding')]
             print(f"✅ 成功获取模型列表")
-            print(f"📊 模型数量: {len(data['data'])}")
-            print(f"📋 前5个模型:")
-            for model in data['data'][:5]:
-                print(f"   - {model['id']}")
-            print(f"   ... 共 {len(data['data'])} 个模型")
-            return True
+            print(f"📊 模型数量: {len(models)}")
+            return models
         else:
             print(f"❌ 请求失败: {response.status_code}")
             print(response.text)
-            return False
+            return None
     except Exception as e:
         print(f"❌ 错误: {e}")
-        return False
+        return None
 
-def test_chat_completion(model_name, test_message):
-    """测试单个模型的聊天完成"""
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
+def check_completion(model_name, test_message):
+    """非流式请求：校验返回的消息内容"""
     payload = {
         "model": model_name,
-        "messages": [
-            {"role": "user", "content": test_message}
-        ],
+        "messages": [{"role": "user", "content": test_message}],
         "stream": False,
         "max_tokens": 100
     }
-    
+    start = time.perf_counter()
+    response = get_session().post(f"{API_URL}/v1/chat/completions", json=payload, timeout=10)
+    latency = time.perf_counter() - start
+    if response.status_code != 200:
+        return latency, None, f"HTTP {response.status_code}"
+    data = response.json()
+    content = data['choices'][0]['message']['content']
+    if not content:
+        return latency, None, "空响应"
+    if data.get('model') != model_name:
+        return latency, None, f"model 不一致: {data.get('model')}"
+    return latency, None, None
+
+def check_stream(model_name, test_message):
+    """流式请求：校验 SSE 格式、chunk id 一致且以 [DONE] 结束，同时记录首字节时间"""
+    payload = {
+        "model": model_name,
+        "messages": [{"role": "user", "content": test_message}],
+        "stream": True
+    }
+    start = time.perf_counter()
+    response = get_session().post(f"{API_URL}/v1/chat/completions", json=payload, stream=True, timeout=10)
+    if response.status_code != 200:
+        response.close()
+        return time.perf_counter() - start, None, f"HTTP {response.status_code}"
+    ttfb = None
+    ids = set()
+    content = ""
+    done = False
+    for line in response.iter_lines():
+        if ttfb is None:
+            ttfb = time.perf_counter() - start
+        if not line.startswith(b"data: "):
+            continue  # 空行与 SSE 注释
+        if line == b"data: [DONE]":
+            done = True
+            continue
+        chunk = json.loads(line[6:])
+        ids.add(chunk['id'])
+        content += chunk['choices'][0]['delta'].get('content', '')
+    latency = time.perf_counter() - start
+    if not done:
+        return latency, ttfb, "缺少 [DONE]"
+    if len(ids) != 1:
+        return latency, ttfb, f"chunk id 不一致 ({len(ids)} 个)"
+    if not content:
+        return latency, ttfb, "空响应"
+    return latency, ttfb, None
+
+def run_case(model_name, test_message, stream):
+    check = check_stream if stream else check_completion
     try:
-        response = requests.post(
-            f"{API_URL}/v1/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=10
-        )
-        
-        if response.status_code == 200:
-            data = response.json()
-            content = data['choices'][0]['message']['content']
-            # 截取前100个字符
-            preview = content[:100] + "..." if len(content) > 100 else content
-            print(f"✅ {model_name:30} | 响应: {preview}")
-            return True
-        else:
-            print(f"❌ {model_name:30} | 错误: {response.status_code}")
-            return False
+        latency, ttfb, error = check(model_name, test_message)
     except Exception as e:
-        print(f"❌ {model_name:30} | 异常: {str(e)[:50]}")
-        return False
+        latency, ttfb, error = None, None, str(e)[:80]
+    return {
+        "model": model_name,
+        "message": test_message,
+        "stream": stream,
+        "ok": error is None,
+        "latency_ms": round(latency * 1000, 2) if latency is not None else None,
+        "ttfb_ms": round(ttfb * 1000, 2) if ttfb is not None else None,
+        "error": error,
+    }
 
-def test_all_models():
-    """测试所有模型"""
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def test_all_models(models, concurrency, modes):
+    """并发测试 模型 × 测试消息 × 模式 的全部组合"""
+    cases = [(model, message, stream) for model in models for message in TEST_MESSAGES for stream in modes]
     print("\n" + "=" * 60)
-    print("测试所有模型的聊天完成功能")
+    print(f"测试所有模型的聊天完成功能 ({len(cases)} 个请求，并发 {concurrency})")
     print("=" * 60)
-    
-    success_count = 0
-    failed_count = 0
-    
-    # 测试不同类型的消息
-    test_messages = [
-        "Hello, what model are you?",
-        "写一段Python代码",
-        "Explain quantum computing",
-    ]
-    
-    for i, model in enumerate(MODELS, 1):
-        # 使用轮换的测试消息
-        test_msg = test_messages[i % len(test_messages)]
-        print(f"\n[{i}/{len(MODELS)}] 测试模型: {model}")
-        
-        if test_chat_completion(model, test_msg):
-            success_count += 1
-        else:
-            failed_count += 1
-        
-        # 避免请求过快
-        time.sleep(0.5)
-    
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda case: run_case(*case), cases))
+    elapsed = time.perf_counter() - start
+
+    print(f"\n{'模型':<28} {'通过':>7} {'p50 ms':>9} {'max ms':>9} {'TTFB ms':>9}")
+    print("-" * 66)
+    for model in models:
+        rows = [r for r in results if r['model'] == model]
+        passed = sum(r['ok'] for r in rows)
+        latencies = [r['latency_ms'] for r in rows if r['latency_ms'] is not None]
+        ttfbs = [r['ttfb_ms'] for r in rows if r['ttfb_ms'] is not None]
+        mark = "✅" if passed == len(rows) else "❌"
+        print(f"{mark} {model:<26} {passed:>3}/{len(rows):<3} {percentile(latencies, 50):>9.1f} "
+              f"{max(latencies, default=0):>9.1f} {percentile(ttfbs, 50):>9.1f}")
+
+    failures = [r for r in results if not r['ok']]
+    for r in failures:
+        mode = "stream" if r['stream'] else "non-stream"
+        print(f"❌ {r['model']} [{mode}] {r['message'][:20]!r}: {r['error']}")
+
     print("\n" + "=" * 60)
     print("测试结果汇总")
     print("=" * 60)
-    print(f"✅ 成功: {success_count}/{len(MODELS)}")
-    print(f"❌ 失败: {failed_count}/{len(MODELS)}")
-    print(f"📊 成功率: {(success_count/len(MODELS)*100):.1f}%")
+    print(f"✅ 成功: {len(results) - len(failures)}/{len(results)}")
+    print(f"❌ 失败: {len(failures)}/{len(results)}")
+    print(f"⏱️  耗时: {elapsed:.2f} 秒")
 
-def test_stream_response():
-    """测试流式响应"""
-    print("\n" + "=" * 60)
-    print("测试流式响应 (使用 gpt-5 模型)")
-    print("=" * 60)
-    
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    payload = {
-        "model": "gpt-5",
-        "messages": [
-            {"role": "user", "content": "Count from 1 to 5"}
-        ],
-        "stream": True
+    latencies = [r['latency_ms'] for r in results if r['latency_ms'] is not None]
+    return {
+        "api_url": API_URL,
+        "models": len(models),
+        "requests": len(results),
+        "passed": len(results) - len(failures),
+        "failed": len(failures),
+        "elapsed_s": round(elapsed, 3),
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "max": max(latencies, default=0),
+        },
+        "failures": failures,
+        "results": results,
     }
-    
-    try:
-        response = requests.post(
-            f"{API_URL}/v1/chat/completions",
-            headers=headers,
-            json=payload,
-            stream=True,
-            timeout=10
-        )
-        
-        if response.status_code == 200:
-            print("✅ 流式响应成功，接收到的数据块:")
-            chunk_count = 0
-            for line in response.iter_lines():
-                if line:
-                    chunk_count += 1
-                    line_str = line.decode('utf-8')
-                    if chunk_count <= 3:
-                        print(f"   块 {chunk_count}: {line_str[:100]}...")
-            print(f"   ... 共接收 {chunk_count} 个数据块")
-            return True
-        else:
-            print(f"❌ 流式响应失败: {response.status_code}")
-            return False
-    except Exception as e:
-        print(f"❌ 流式响应错误: {e}")
-        return False
 
 def main():
     """主测试函数"""
+    parser = argparse.ArgumentParser(description='测试所有支持的模型')
+    parser.add_argument('-c', '--concurrency', type=int, default=16, help='并发请求数，线程引擎下不宜超过服务器线程数 (默认: 16)')
+    parser.add_argument('--mode', choices=['both', 'stream', 'non-stream'], default='both',
+                        help='测试模式 (默认: both)')
+    parser.add_argument('--json', metavar='PATH', help='将 JSON 汇总写入文件（- 表示输出到标准输出）')
+    args = parser.parse_args()
+    modes = {'both': (False, True), 'stream': (True,), 'non-stream': (False,)}[args.mode]
+
     print("\n")
     print("🚀 " + "=" * 58)
     print("   Advanced AI Models API - 完整测试")
     print("   API URL: " + API_URL)
-    print("   模型总数: " + str(len(MODELS)))
     print("=" * 60)
-    
+
     # 1. 测试模型列表
-    models_ok = test_models_endpoint()
-    
-    # 2. 测试所有模型
-    if models_ok:
-        test_all_models()
-    
-    # 3. 测试流式响应
-    test_stream_response()
-    
+    models = fetch_models()
+    if not models:
+        sys.exit(1)
+
+    # 2. 并发测试所有模型（流式与非流式）
+    summary = test_all_models(models, max(1, args.concurrency), modes)
+
+    if args.json == '-':
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    elif args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"💾 JSON 汇总已保存到 {args.json}")
+
     print("\n" + "=" * 60)
     print("🎉 测试完成！")
     print("=" * 60)
+    sys.exit(1 if summary['failed'] else 0)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()